@@ -0,0 +1,193 @@
+'''
+Adaptive mesh refinement of target volumes for the Biot-Savart calculator in biot_savart_v4_3.py
+
+The box is covered by blocks, each a small uniform grid of a few cells per axis. Starting from the coarse grid
+of vol_resolution, the block with the largest interpolation error estimate is split into 8 blocks of half the
+spacing, until the point budget is spent. Far from the copper the blocks stay coarse, next to the tracks
+they are refined many times.
+
+The volume is resampled onto a uniform grid for plot_fields and plot_3d_fields.
+
+All lengths are in cm, B-field is in G
+'''
+import heapq
+import itertools
+import numpy as np
+import biot_savart_v4_3 as bs
+
+class AdaptiveVolume:
+    '''
+    Target volume on a block-structured adaptive grid, see produce_adaptive_volume.
+
+    box_size, start_point, vol_resolution: the box and the coarsest spacing
+    blocks: list of leaf blocks (axes, field, level), axes the (x, y, z) node coordinates of the block
+        and field the (nx, ny, nz, 3) field on its nodes. Neighbouring blocks share their boundary nodes.
+    n_points: number of field evaluations spent
+    '''
+    def __init__(self, box_size, start_point, vol_resolution, blocks, n_points):
+        self.box_size, self.start_point, self.vol_resolution = tuple(box_size), tuple(start_point), vol_resolution
+        self.blocks = blocks
+        self.n_points = n_points
+
+    def points(self):
+        '''
+        Returns (positions (N, 3), fields (N, 3)) of all block nodes, e.g. for a scatter plot of the refinement.
+        '''
+        positions, fields = [], []
+        for axes, field, _ in self.blocks:
+            X, Y, Z = np.meshgrid(*axes, indexing='ij')
+            positions.append(np.stack([X.ravel(), Y.ravel(), Z.ravel()], axis=1))
+            fields.append(field.reshape(-1, 3))
+        return np.concatenate(positions), np.concatenate(fields)
+
+    def grid(self, vol_resolution=None):
+        '''
+        Returns the uniform grid of uniform(vol_resolution) as keyword arguments of plot_fields and plot_3d_fields.
+        '''
+        return {"box_size": self.box_size, "start_point": self.start_point, "vol_resolution": vol_resolution or self.vol_resolution}
+
+    def uniform(self, vol_resolution=None):
+        '''
+        Resamples the volume onto the uniform grid of grid_axes(box_size, start_point, vol_resolution)
+        by trilinear interpolation inside the finest block covering every point.
+
+        vol_resolution: Spacing of the uniform grid, by default the coarsest spacing
+
+        Returns an (nx, ny, nz, 3) array indexed like produce_target_volume, e.g.
+        plot_fields(volume.uniform(0.05), **volume.grid(0.05))
+        '''
+        axes = bs.grid_axes(self.box_size, self.start_point, vol_resolution or self.vol_resolution)
+        uniform = np.zeros(tuple(len(axis) for axis in axes) + (3,))
+
+        for block_axes, field, _ in sorted(self.blocks, key=lambda block: block[2]):
+            index, fraction, window = [], [], []
+            for axis, nodes in zip(axes, block_axes):
+                lo, hi = np.searchsorted(axis, nodes[0] - 1e-12), np.searchsorted(axis, nodes[-1] + 1e-12)
+                cell = np.clip(np.searchsorted(nodes, axis[lo:hi], side='right') - 1, 0, max(len(nodes) - 2, 0))
+                width = np.diff(nodes)[cell] if len(nodes) > 1 else np.ones(hi - lo)
+                index.append(cell)
+                fraction.append((axis[lo:hi] - nodes[cell]) / width if len(nodes) > 1 else np.zeros(hi - lo))
+                window.append(slice(lo, hi))
+            if min(len(i) for i in index) == 0: continue
+            # uniform points inside the block, the cell and position inside the cell along every axis
+
+            resampled = 0
+            for corner in np.ndindex(2, 2, 2):
+                weight = 1
+                corner_index = []
+                for c in range(3):
+                    step = corner[c] if len(block_axes[c]) > 1 else 0
+                    corner_index.append(index[c] + step)
+                    weight = np.multiply.outer(weight, fraction[c] if corner[c] else 1 - fraction[c])
+                resampled = resampled + weight[..., None] * field[np.ix_(*corner_index)]
+            uniform[tuple(window)] = resampled
+            # finer blocks are written last and win on shared faces
+
+        return uniform
+
+def _block_error(field, level):
+    '''
+    Estimates the trilinear interpolation error of a block from the second differences of its field,
+    weighted by the volume of the block (1 / 8**level). Without the weight the whole budget would go into
+    refining the 1 / r singularity right at the tracks.
+    '''
+    error = 0.0
+    for c in range(3):
+        if field.shape[c] > 2: error = max(error, float(np.linalg.norm(np.diff(field, 2, axis=c), axis=-1).max()) / 8)
+    return error / 8**level
+
+def _refined_axes(axes):
+    '''
+    Returns the node coordinates of a block at half its spacing.
+    '''
+    fine = []
+    for nodes in axes:
+        half = np.empty(2 * len(nodes) - 1)
+        half[0::2] = nodes
+        half[1::2] = (nodes[1:] + nodes[:-1]) / 2
+        fine.append(half)
+    return fine
+
+def _children(axes, field, fine):
+    '''
+    Splits a refined block (node coordinates fine, field at half spacing) into its 8 children.
+    '''
+    children = []
+    for corner in np.ndindex(2, 2, 2):
+        window = []
+        for c in range(3):
+            middle = len(axes[c]) - 1
+            window.append(slice(middle, None) if corner[c] else slice(0, middle + 1))
+        children.append(([fine[c][window[c]] for c in range(3)], field[tuple(window)]))
+    return children
+
+def produce_adaptive_volume(coil, box_size, start_point, vol_resolution, max_points, block=4, max_level=10,
+                            max_bytes=bs.DEFAULT_MAX_BYTES, engine='midpoint', **engine_options):
+    '''
+    Generates an adaptive target volume that refines the grid where the field changes fastest.
+
+    Coil: Input Coil Positions in format specified above (sub-divided with slice_coil for the 'midpoint' engine)
+    box_size: (x, y, z) dimensions of the box in cm
+    start_point: (x, y, z) = (0, 0, 0) = bottom left corner position of the box
+    vol_resolution: Coarsest spacing (in cm), the starting grid
+    max_points: Budget of field evaluations, incl. the starting grid
+    block: Number of cells per axis of a block
+    max_level: Maximum number of refinements of a block, the finest spacing is vol_resolution / 2**max_level
+    max_bytes, engine_options: see produce_target_volume
+    engine: Name of the field engine in ENGINES, except 'fft' (blocks are too small for it)
+
+    Returns an AdaptiveVolume
+    '''
+    if engine not in bs.ENGINES or engine == 'fft':
+        raise ValueError(f"the adaptive volume needs one of {[name for name in bs.ENGINES if name != 'fft']}, not '{engine}'")
+    coil = np.asarray(coil, dtype=float)
+    if engine in bs._PREPARE: coil, engine_options = bs._PREPARE[engine](coil, **engine_options)
+
+    def evaluate(points):
+        return bs.ENGINES[engine](coil, points[:, 0], points[:, 1], points[:, 2], max_bytes, **engine_options)
+
+    axes = bs.grid_axes(box_size, start_point, vol_resolution)
+    n_points = int(np.prod([len(axis) for axis in axes]))
+    if n_points > max_points: raise ValueError(f"the starting grid already has {n_points} points, more than max_points")
+
+    X, Y, Z = np.meshgrid(*axes, indexing='ij')
+    coarse = evaluate(np.stack([X.ravel(), Y.ravel(), Z.ravel()], axis=1)).reshape(X.shape + (3,))
+
+    leaves, heap, keys = {}, [], itertools.count()
+    splits = [range(0, max(len(axis) - 1, 1), block) for axis in axes]
+    for i in splits[0]:
+        for j in splits[1]:
+            for k in splits[2]:
+                window = tuple(slice(a, a + block + 1) for a in (i, j, k))
+                leaves[next(keys)] = ([axis[w] for axis, w in zip(axes, window)], coarse[window], 0)
+    for key, (_, field, _) in leaves.items(): heapq.heappush(heap, (-_block_error(field, 0), key))
+    # max-heap of the leaves by error estimate
+
+    while heap:
+        _, key = heap[0]
+        block_axes, field, level = leaves[key]
+        fine = _refined_axes(block_axes)
+        shape = tuple(len(nodes) for nodes in fine)
+        cost = int(np.prod(shape)) - field.shape[0] * field.shape[1] * field.shape[2]
+        if level >= max_level or n_points + cost > max_points:
+            heapq.heappop(heap)
+            continue
+        # leaves that cannot be refined any further drop out
+
+        refined = np.empty(shape + (3,))
+        refined[0::2, 0::2, 0::2] = field
+        new = np.ones(shape, dtype=bool)
+        new[0::2, 0::2, 0::2] = False
+        X, Y, Z = np.meshgrid(*fine, indexing='ij')
+        refined[new] = evaluate(np.stack([X[new], Y[new], Z[new]], axis=1))
+        n_points += cost
+        # the nodes of the block are reused, only the new half-spacing nodes are evaluated
+
+        heapq.heappop(heap)
+        del leaves[key]
+        for child_axes, child_field in _children(block_axes, refined, fine):
+            child = next(keys)
+            leaves[child] = (child_axes, child_field, level + 1)
+            heapq.heappush(heap, (-_block_error(child_field, level + 1), child))
+
+    return AdaptiveVolume(box_size, start_point, vol_resolution, list(leaves.values()), n_points)
@@ -0,0 +1,198 @@
+'''
+Analytic field of circular arcs for the Biot-Savart calculator in biot_savart_v4_3.py
+
+Arcs are taken directly instead of being sliced into straight pieces, as a (7, M) array with one column per arc:
+    x, y, z (centre), r (radius), phi_start, phi_end (radians), I
+in planes parallel to the x-y plane. The current I flows from phi_start to phi_end, i.e. counter-clockwise if
+phi_end > phi_start; a full circle has |phi_end - phi_start| = 2 pi.
+
+In the frame of a point at distance rho from the axis of the arc, height z above its plane and psi = phi - phi_point,
+    B_rho = I a z I1,   B_z = I a (a I0 - rho I1),   B_phi = I z (1 / sqrt(D(psi_start)) - 1 / sqrt(D(psi_end))) / rho
+with D = rho^2 + a^2 + z^2 - 2 a rho cos(psi), I0 = integral of dpsi / D^(3/2) and I1 = integral of cos(psi) dpsi / D^(3/2).
+Substituting psi = pi - 2 theta turns I0 and I1 into incomplete elliptic integrals of the parameter
+m = 4 a rho / ((a + rho)^2 + z^2), which are evaluated in Carlson's symmetric forms (scipy.special.elliprf, elliprd)
+without cancellation for any m; full circles only need the complete integrals (scipy.special.ellipk, ellipe).
+
+Arcs of the KiCad files of simple_coils/coil_circle.py (gr_arc with start, mid and end) are read by read_kicad_arcs.
+
+All lengths are in cm, B-field is in G
+'''
+import re
+import numpy as np
+import scipy.special
+import biot_savart_v4_3 as bs
+
+ON_CIRCLE = 1e-12
+# 1 - m below which a point counts as on the circle of an arc; points on the arc itself (the copper) get no contribution
+SMALL_M = 1e-3
+# m below which the complete integrals are taken from R_D, (E / (1 - m) - K) / m would cancel
+
+def arc_from_points(start, mid, end, z=0.0, current=1.0):
+    '''
+    Returns the arc (7,) through the (x, y) points start, mid and end, running from start through mid to end.
+    '''
+    (x1, y1), (x2, y2), (x3, y3) = (np.asarray(p, dtype=float) for p in (start, mid, end))
+    det = 2 * ((x2 - x1) * (y3 - y1) - (y2 - y1) * (x3 - x1))
+    if det == 0: raise ValueError(f"arc points {start}, {mid}, {end} are collinear")
+    q1, q2 = (x2**2 + y2**2) - (x1**2 + y1**2), (x3**2 + y3**2) - (x1**2 + y1**2)
+    cx = (q1 * (y3 - y1) - q2 * (y2 - y1)) / det
+    cy = (q2 * (x2 - x1) - q1 * (x3 - x1)) / det
+    # circumcentre
+
+    phi_start, phi_mid, phi_end = (np.arctan2(py - cy, px - cx) for px, py in ((x1, y1), (x2, y2), (x3, y3)))
+    sweep_mid, sweep_end = (phi_mid - phi_start) % (2 * np.pi), (phi_end - phi_start) % (2 * np.pi)
+    sweep = sweep_end if sweep_mid < sweep_end else sweep_end - 2 * np.pi
+    # counter-clockwise if mid comes first going counter-clockwise from start, clockwise otherwise
+
+    return np.array([cx, cy, z, np.hypot(x1 - cx, y1 - cy), phi_start, phi_start + sweep, current])
+
+def read_kicad_arcs(filename, layer=None, z=0.0, current=1.0):
+    '''
+    Returns the arcs (7, M) of the gr_arc entries (start, mid, end) of a .kicad_pcb file, on the given layer
+    (or all layers), converted from mm to cm like the coil files of main.main.
+    '''
+    number = r'(-?[\d.]+(?:[eE][-+]?\d+)?)'
+    pattern = re.compile(r'\(gr_arc\s*\(start ' + number + r'\s+' + number + r'\)\s*\(mid ' + number + r'\s+' + number +
+                         r'\)\s*\(end ' + number + r'\s+' + number + r'\).*?\(layer\s+"([^"]+)"\)', re.DOTALL)
+    with open(filename, "r") as f: text = f.read()
+
+    arcs = [arc_from_points((float(m[1]) / 10, float(m[2]) / 10), (float(m[3]) / 10, float(m[4]) / 10),
+                            (float(m[5]) / 10, float(m[6]) / 10), z, current)
+            for m in pattern.finditer(text) if layer is None or m[7] == layer]
+    return np.array(arcs).T.reshape(7, -1)
+
+def arcs_to_coil(arcs, pieces=100):
+    '''
+    Returns the arcs (7, M) as a coil (4, N) of pieces straight segments per full turn (at least one per arc),
+    e.g. to compare with or combine with the other engines. Consecutive arcs are joined by segments without current.
+    '''
+    arcs = np.asarray(arcs, dtype=float).reshape(7, -1)
+    columns = []
+    for x, y, z, r, phi_start, phi_end, current in arcs.T:
+        n = max(1, int(np.ceil(pieces * abs(phi_end - phi_start) / (2 * np.pi))))
+        phi = np.linspace(phi_start, phi_end, n + 1)
+        I = np.full(n + 1, current)
+        I[-1] = 0
+        # the current of the last vertex is the one of the joint to the next arc
+        columns.append(np.array([x + r * np.cos(phi), y + r * np.sin(phi), np.full(n + 1, z), I]))
+    return np.hstack(columns) if columns else np.zeros((4, 0))
+
+def _incomplete(theta, m, delta2):
+    '''
+    Returns the integrals from 0 to theta (|theta| <= pi / 2) of dtheta / Delta^3 and sin^2 dtheta / Delta^3,
+    Delta^2 = 1 - m sin^2 = delta2 at theta (passed, as it is computed without cancellation).
+    '''
+    s, c = np.sin(theta), np.cos(theta)
+    RF = scipy.special.elliprf(c * c, delta2, 1.0)
+    RD = scipy.special.elliprd(c * c, 1.0, delta2)
+    S = s**3 * RD / 3
+    return s * RF + m * S, S
+
+def _complete(m, k2):
+    '''
+    Returns the integrals of _incomplete from 0 to pi / 2, for k2 = 1 - m: E / k2 and (E / k2 - K) / m.
+    '''
+    K = scipy.special.ellipkm1(k2)
+    J = scipy.special.ellipe(m) / k2
+    S = (J - K) / np.where(m < SMALL_M, 1.0, m)
+    small = m < SMALL_M
+    if small.any(): S[small] = scipy.special.elliprd(0.0, 1.0, k2[small]) / 3
+    return J, S
+
+def _arc_pairs(a, phi_start, phi_end, rho, phi, z, full):
+    '''
+    Returns B_rho, B_phi and B_z (per unit current, without the mu_0 / 4pi FACTOR) of arcs of radius a from phi_start
+    to phi_end about the origin, at points (rho, phi, z) in cylindrical coordinates; all arguments broadcast to (arcs, points).
+    full: if set, all arcs are full circles
+    '''
+    shape = np.broadcast_shapes(np.shape(a), np.shape(rho))
+    m0 = (a + rho)**2 + z * z
+    k2 = np.broadcast_to(((a - rho)**2 + z * z) / m0, shape)
+    m = np.broadcast_to(4 * a * rho / m0, shape)
+    # 1 - m without cancellation
+
+    psi_start, psi_end = phi_start - phi, phi_end - phi
+    theta = ((np.pi - psi_end) / 2, (np.pi - psi_start) / 2)
+    # psi = pi - 2 theta, theta runs the other way: integral dpsi = 2 integral from theta[0] to theta[1] dtheta
+    turns = [np.round(t / np.pi) for t in theta]
+    reduced = [t - n * np.pi for t, n in zip(theta, turns)]
+    delta2 = [k2 + m * np.cos(t)**2 for t in reduced]
+    # Delta is pi-periodic in theta, J(theta + n pi) = J(theta) + 2 n J(pi / 2)
+    wrap = np.broadcast_to(turns[1] != turns[0], shape)
+
+    on_arc = (k2 <= ON_CIRCLE) & (wrap | full | (delta2[0] <= ON_CIRCLE) | (delta2[1] <= ON_CIRCLE))
+    # the integrand is singular only if the range passes theta = pi / 2 (mod pi) on the circle, i.e. the point is on the arc
+    k2, m = np.where(on_arc, 1.0, k2), np.where(on_arc, 0.0, m)
+    delta2 = [np.where(on_arc, 1.0, d) for d in delta2]
+
+    if full:
+        Jc, Sc = _complete(m, k2)
+        sign = np.sign(phi_end - phi_start)
+        J, S = 4 * sign * Jc, 4 * sign * Sc
+        B_phi = np.zeros(shape)
+    else:
+        (J0, S0), (J1, S1) = (_incomplete(t, m, d) for t, d in zip(reduced, delta2))
+        J, S = J1 - J0, S1 - S0
+        if wrap.any():
+            Jc, Sc = _complete(m[wrap], k2[wrap])
+            n = np.broadcast_to(turns[1] - turns[0], shape)[wrap]
+            J[wrap] += 2 * n * Jc
+            S[wrap] += 2 * n * Sc
+        J, S = 2 * J, 2 * S
+
+        root_start, root_end = (np.sqrt(np.where(on_arc, 1.0, (a - rho)**2 + z * z + 4 * a * rho * np.sin(psi / 2)**2))
+                                for psi in (psi_start, psi_end))
+        B_phi = z * 2 * a * (np.cos(psi_start) - np.cos(psi_end)) / (root_start * root_end * (root_start + root_end))
+        # 1 / sqrt(D_start) - 1 / sqrt(D_end) = (D_end - D_start) / (...), D_end - D_start = 2 a rho (cos psi_start - cos psi_end)
+
+    scale = 1 / (m0 * np.sqrt(m0))
+    I0, I1 = scale * J, scale * (2 * S - J)
+    # cos(psi) = 2 sin^2(theta) - 1
+
+    B_rho, B_z = a * z * I1, a * (a * I0 - rho * I1)
+    return tuple(np.where(on_arc, 0.0, B) for B in (B_rho, B_phi, B_z))
+
+def calculate_arc_field(arcs, x, y, z, max_bytes=bs.DEFAULT_MAX_BYTES):
+    '''
+    Calculates magnetic field vector as a result of some position and current x, y, z, I
+    of circular arcs, exactly.
+
+    arcs: (7, M) arcs, see above
+    x, y, z: position in cm
+    max_bytes: Upper bound for the scratch memory used per block of (arcs x positions)
+
+    Output B-field is a 3-D vector in units of G, in the same layout as calculate_field
+    '''
+    arcs = np.asarray(arcs, dtype=float).reshape(7, -1)
+    if (arcs[3] <= 0).any(): raise ValueError("arc radii must be positive")
+    points, shape = bs._as_points(x, y, z)
+    B = np.zeros((len(points), 3))
+
+    source_block, point_block = bs._block_sizes(arcs.shape[1], len(points), 8 * 40, max_bytes)
+    for s0 in range(0, arcs.shape[1], source_block):
+        cx, cy, cz, a, phi_start, phi_end, current = (row[:, None] for row in arcs[:, s0:s0+source_block])
+        full = np.abs(np.abs(phi_end - phi_start) - 2 * np.pi) <= 1e-12
+        for p0 in range(0, len(points), point_block):
+            P = points[p0:p0+point_block]
+            dx, dy, dz = P[None, :, 0] - cx, P[None, :, 1] - cy, P[None, :, 2] - cz
+            rho, phi = np.hypot(dx, dy), np.arctan2(dy, dx)
+            for group, complete in ((full[:, 0], True), (~full[:, 0], False)):
+                # full circles only need the complete integrals
+                if not group.any(): continue
+                B_rho, B_phi, B_z = _arc_pairs(a[group], phi_start[group], phi_end[group], rho[group], phi[group], dz[group], complete)
+                c, s = np.cos(phi[group]), np.sin(phi[group])
+                I = current[group]
+                B[p0:p0+len(P), 0] += (I * (B_rho * c - B_phi * s)).sum(axis=0)
+                B[p0:p0+len(P), 1] += (I * (B_rho * s + B_phi * c)).sum(axis=0)
+                B[p0:p0+len(P), 2] += (I * B_z).sum(axis=0)
+
+    return (B * bs.FACTOR).reshape(shape)
+
+def produce_arc_volume(arcs, box_size, start_point, vol_resolution, max_bytes=bs.DEFAULT_MAX_BYTES):
+    '''
+    Returns the field of the arcs on the target volume grid of produce_target_volume, indexed [x, y, z, component],
+    e.g. for save_target_volume.
+    '''
+    x, y, z = bs.grid_axes(box_size, start_point, vol_resolution)
+    Z, Y, X = np.meshgrid(z, y, x, indexing='ij')
+    return calculate_arc_field(arcs, X, Y, Z, max_bytes)
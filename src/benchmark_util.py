@@ -0,0 +1,249 @@
+'''
+Benchmark and accuracy suite of the Biot-Savart calculator in biot_savart_v4_3.py
+
+Generates the 9-turn square and the 91-turn octagonal coils of the examples with main.main and measures
+slice_coil, the field engines and produce_target_volume (with the midpoint engine and with the default 'auto') on them,
+sweeping the number of coil pieces and of grid points: throughput (evaluations per second, best of several runs) and
+peak memory (numpy allocations, via tracemalloc). The accuracy of every engine is checked against the analytic on-axis
+field of a circular loop. The fft engine is measured on grids at least bs.FFT_MIN_DISTANCE grid spacings above the
+coil plane, where it is meant to be used.
+
+The results are stored as a JSON baseline; later runs are compared to it and fail (exit code 1) when the
+throughput drops, the peak memory grows or the error grows beyond the allowed slack:
+
+    python benchmark_util.py --update      # measure and store the baseline of this machine
+    python benchmark_util.py               # measure and compare with it
+
+All lengths are in cm, B-field is in G
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import contextlib
+import io
+import tracemalloc
+import numpy as np
+import biot_savart_v4_3 as bs
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+
+COILS = {
+    "square": dict(innerDiameter=25000, outerDiameter=50000, segmentLength=100, turnsTotal=9, trackWidth=1270, trackGap=1270,
+                   drill=0.15, straight=True, vertices=4, pos_x=38, pos_y=38, layer="F.Cu", coil_only=False, via_outer=0.25, no_plots=True),
+    "octagon": dict(innerDiameter=0, outerDiameter=47240, segmentLength=100, turnsTotal=91, trackWidth=127, trackGap=127,
+                    drill=150, straight=True, vertices=8, pos_x=0, pos_y=0, layer="F.Cu", coil_only=False, via_outer=250, no_plots=True),
+}
+# main.main parameters of the coils of the examples: the default of main.py and the coil of script_9_coils.py
+
+SLICE_RESOLUTIONS = (0.01, 0.002)
+COIL_RESOLUTIONS = (0.2, 0.05)
+GRID_POINTS = (8, 16)
+# sweeps: slice_coil steps (cm) timed on their own and used for the field engines,
+# and grid points per axis of the evaluation box around the coil
+ENGINES = {'midpoint': {}, 'planar': {}, 'segment': {}, 'gauss': {}, 'tree': {'tolerance': 1e-3}, 'fft': {},
+           'multipole': {'tolerance': 1e-3}, 'separable': {}}
+SLICED = ('midpoint', 'planar', 'tree', 'multipole')
+# engines measured, with their options, and the ones that need the coil sliced
+
+LOOP_RADIUS = 2.0
+LOOP_VERTICES = 4096
+LOOP_SLICE = 0.001
+# the circular loop of the accuracy check: the polygon differs from the circle by ~ (pi / LOOP_VERTICES)^2 / 3,
+# sliced into pieces shorter than its sides for the midpoint rule (which otherwise extrapolates over pairs of sides)
+
+FFT_LOOP_POINTS = 129
+# x-y grid points per axis of the fft accuracy check (over 3 LOOP_RADIUS), which uses the z levels from LOOP_Z_CLEAR up
+LOOP_Z_CLEAR = bs.FFT_MIN_DISTANCE * 3 * LOOP_RADIUS / (FFT_LOOP_POINTS - 1)
+
+MIN_SECONDS = 0.2
+# fast measurements are repeated for at least this long, so that the best run is not a fluke
+
+def make_coils(directory):
+    '''
+    Runs main.main for every coil of COILS in directory and returns {name: coil}.
+    '''
+    import main
+    coils = {}
+    cwd = os.getcwd()
+    os.makedirs(os.path.join(directory, "results"), exist_ok=True)
+    try:
+        os.chdir(directory)
+        for name, parameters in COILS.items():
+            with contextlib.redirect_stdout(io.StringIO()):
+                main.main(**parameters)
+            turns = parameters["turnsTotal"]
+            filename = next(entry for entry in os.listdir("results") if entry.endswith(".txt") and entry.startswith(f"{turns}_turn"))
+            coils[name] = bs.parse_coil(os.path.join("results", filename), sidecar=False)
+            os.remove(os.path.join("results", filename))
+    finally:
+        os.chdir(cwd)
+    return coils
+
+def loop_coil(radius=LOOP_RADIUS, n=LOOP_VERTICES, current=1.0):
+    '''
+    Returns a closed polygon of n vertices on the circle of radius about the origin in the x-y plane, as a coil.
+    '''
+    phi = np.linspace(0, 2 * np.pi, n + 1)
+    return np.array([radius * np.cos(phi), radius * np.sin(phi), np.zeros(n + 1), np.full(n + 1, current)])
+
+def loop_axis_field(z, radius=LOOP_RADIUS, current=1.0):
+    '''
+    Returns the analytic B_z (in G) of a circular loop on its axis: mu_0 I R^2 / (2 (R^2 + z^2)^(3/2)).
+    '''
+    return bs.FACTOR * 2 * np.pi * current * radius**2 / (radius**2 + np.asarray(z)**2)**1.5
+
+def measure(function, repeat):
+    '''
+    Runs function repeat times (and for at least MIN_SECONDS) and returns
+    (best run time in s, peak of traced memory in bytes of one more run, result).
+    '''
+    best, runs, start = np.inf, 0, time.perf_counter()
+    while runs < repeat or time.perf_counter() - start < MIN_SECONDS:
+        t0 = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - t0)
+        runs += 1
+
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return best, peak, result
+
+def _box_points(coil, n, clear=False):
+    '''
+    Returns n^3 points (as x, y, z arrays) on a grid over the footprint of coil, from 0.5 cm below to 0.5 cm above it,
+    or with clear set over 1 cm starting bs.FFT_MIN_DISTANCE x-y grid spacings above the coil (for the fft engine).
+    '''
+    lo, hi = coil[:3].min(axis=1) - 0.5, coil[:3].max(axis=1) + 0.5
+    if clear:
+        lo[2] = coil[2].max() + bs.FFT_MIN_DISTANCE * float((hi - lo)[:2].max()) / (n - 1)
+        hi[2] = lo[2] + 1
+    axes = [np.linspace(lo[c], hi[c], n) for c in range(3)]
+    Z, Y, X = np.meshgrid(axes[2], axes[1], axes[0], indexing='ij')
+    return X, Y, Z
+
+def _fft_axis_field(loop, z, n=FFT_LOOP_POINTS, **options):
+    '''
+    Returns the field of the fft engine on the axis of the loop at the z levels (all clear of the loop plane),
+    taken from the centre column of an n x n grid (n odd) over the loop.
+    '''
+    half = 1.5 * LOOP_RADIUS
+    x = np.linspace(-half, half, n)
+    Z, Y, X = np.meshgrid(z, x, x, indexing='ij')
+    return bs.ENGINES['fft'](loop, X, Y, Z, **options)[n // 2, n // 2]
+
+def run(repeat=5, log=print):
+    '''
+    Runs all measurements and returns {metric: {"value", "unit", "better": "higher" or "lower"}}.
+    '''
+    results = {}
+    def record(name, value, unit, better):
+        results[name] = {"value": float(value), "unit": unit, "better": better}
+        log(f"{name:48s} {value:12.4g} {unit}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        coils = make_coils(directory)
+
+    for name, coil in coils.items():
+        for resolution in SLICE_RESOLUTIONS:
+            seconds, peak, sliced = measure(lambda: bs.slice_coil(coil, resolution), repeat)
+            record(f"slice_coil/{name}/{resolution}", sliced.shape[1] / seconds, "pieces/s", "higher")
+
+        for resolution in COIL_RESOLUTIONS:
+            sliced = bs.slice_coil(coil, resolution)
+            for n in GRID_POINTS:
+                for engine, options in ENGINES.items():
+                    if engine not in SLICED and resolution != COIL_RESOLUTIONS[0]: continue
+                    # the segment, gauss, fft and separable engines do not depend on the slicing
+                    source = sliced if engine in SLICED else coil
+                    X, Y, Z = _box_points(coil, n, clear=engine == 'fft')
+                    seconds, peak, _ = measure(lambda: bs.ENGINES[engine](source, X, Y, Z, **options), repeat)
+                    key = f"field/{engine}/{name}/{resolution if engine in SLICED else 'raw'}/{n**3}"
+                    record(f"{key}/points", X.size / seconds, "points/s", "higher")
+                    record(f"{key}/peak", peak, "bytes", "lower")
+
+        sliced = bs.slice_coil(coil, COIL_RESOLUTIONS[-1])
+        lo, hi = coil[:3].min(axis=1) - 0.5, coil[:3].max(axis=1) + 0.5
+        box, resolution = hi - lo, float((hi - lo)[:2].max()) / (GRID_POINTS[-1] - 1)
+        n_points = int(np.prod([len(axis) for axis in bs.grid_axes(box, lo, resolution)]))
+        seconds, peak, _ = measure(lambda: bs.produce_target_volume(sliced, box, lo, resolution, engine='midpoint'), repeat)
+        record(f"produce_target_volume/{name}/points", n_points / seconds, "points/s", "higher")
+        record(f"produce_target_volume/{name}/peak", peak, "bytes", "lower")
+        seconds, peak, _ = measure(lambda: bs.produce_target_volume(sliced, box, lo, resolution), repeat)
+        record(f"produce_target_volume/{name}/auto/points", n_points / seconds, "points/s", "higher")
+        record(f"produce_target_volume/{name}/auto/peak", peak, "bytes", "lower")
+        # the default engine, which users run
+
+    loop = loop_coil()
+    z = np.linspace(0.1, 10, 64)
+    exact = loop_axis_field(z)
+    for engine, options in ENGINES.items():
+        source = bs.slice_coil(loop, LOOP_SLICE) if engine in SLICED else loop
+        levels = z >= LOOP_Z_CLEAR if engine == 'fft' else np.ones(len(z), dtype=bool)
+        # fft only clear of the loop plane by bs.FFT_MIN_DISTANCE spacings of its grid
+        if engine == 'fft': B = _fft_axis_field(source, z[levels], **options)
+        else: B = bs.ENGINES[engine](source, np.zeros_like(z), np.zeros_like(z), z, **options)
+        error = max(np.abs(B[:, 2] - exact[levels]).max(), np.abs(B[:, :2]).max()) / np.abs(exact).max()
+        record(f"accuracy/loop_axis/{engine}", error, "relative", "lower")
+
+    return results
+
+def machine():
+    '''
+    Returns a description of this machine and software, stored with the baseline.
+    '''
+    return {"platform": platform.platform(), "processor": platform.processor(), "cpus": os.cpu_count(),
+            "python": platform.python_version(), "numpy": np.__version__}
+
+def compare(results, baseline, slack=0.3, error_slack=0.5):
+    '''
+    Returns the list of regressions of results against the baseline metrics: throughput below (1 - slack) times
+    the baseline, peak memory above (1 + slack) times, errors above (1 + error_slack) times the baseline.
+    Metrics missing from either side are ignored.
+    '''
+    regressions = []
+    for name, entry in results.items():
+        if name not in baseline: continue
+        old, new = baseline[name]["value"], entry["value"]
+        if entry["unit"] == "relative": limit, worse = old * (1 + error_slack) + 1e-15, new > old * (1 + error_slack) + 1e-15
+        elif entry["better"] == "higher": limit, worse = old * (1 - slack), new < old * (1 - slack)
+        else: limit, worse = old * (1 + slack), new > old * (1 + slack)
+        if worse: regressions.append(f"{name}: {new:.4g} {entry['unit']}, baseline {old:.4g} (limit {limit:.4g})")
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark and accuracy suite of the Biot-Savart engines")
+    parser.add_argument("--baseline", default=BASELINE, help="JSON file of the baseline")
+    parser.add_argument("--update", action="store_true", help="Store the results as the new baseline instead of comparing")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per measurement, the fastest counts")
+    parser.add_argument("--slack", type=float, default=0.3, help="Allowed relative loss of throughput and growth of peak memory")
+    parser.add_argument("--output", help="Also write the results of this run to this JSON file")
+    args = parser.parse_args()
+
+    results = run(args.repeat)
+    report = {"machine": machine(), "results": results}
+    if args.output:
+        with open(args.output, "w") as f: json.dump(report, f, indent=1)
+
+    if args.update:
+        with open(args.baseline, "w") as f: json.dump(report, f, indent=1)
+        print(f"baseline written to {args.baseline}")
+        sys.exit(0)
+
+    if not os.path.exists(args.baseline):
+        sys.exit(f"no baseline at {args.baseline}, create one with --update")
+    with open(args.baseline) as f: baseline = json.load(f)
+    if baseline["machine"] != report["machine"]:
+        print(f"warning: the baseline was measured on {baseline['machine']}")
+
+    regressions = compare(results, baseline["results"], args.slack)
+    for regression in regressions: print(f"REGRESSION {regression}")
+    print(f"{len(regressions)} regressions in {len(results)} metrics")
+    sys.exit(1 if regressions else 0)
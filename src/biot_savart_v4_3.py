@@ -8,6 +8,11 @@ All lengths are in cm, B-field is in G
 https://github.com/vuthalab/biot-savart
 '''
 
+import os
+import json
+import hashlib
+import inspect
+import operator
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.cm as cm
@@ -16,13 +21,15 @@ import matplotlib.ticker as ticker
 '''
 Feature Wishlist:
     improve plot_coil with different colors for different values of current
-
-    accelerate integrator to use meshgrids directly instead of a layer of for loop
-
-    get parse_coil to use vectorized function instead of for loop
 '''
 
-def parse_coil(filename):
+def coil_sidecar(filename):
+    '''
+    Name of the binary sidecar of a coil file, see parse_coil and write_coil_sidecar.
+    '''
+    return f"{filename}.npy"
+
+def parse_coil(filename, sidecar=True):
     '''
     Parses 4 column CSV into x,y,z,I slices for coil.
 
@@ -34,8 +41,47 @@ def parse_coil(filename):
     - There are 2 amps of current running between points 1 and 2
     - There are 3 amps of current running between points 2 and 3
     - The last bit of current is functionally useless.
+
+    Blank lines are ignored, any other line that is not 4 comma-separated numbers raises a ValueError with its line number.
+    sidecar: If True and a binary sidecar (filename + ".npy", see write_coil_sidecar) at least as new as the file exists,
+    it is loaded instead of parsing the text.
+
+    Returns a float64 array of shape (4, N)
+    '''
+    binary = coil_sidecar(filename)
+    if sidecar and os.path.exists(binary) and os.path.getmtime(binary) >= os.path.getmtime(filename):
+        return np.load(binary)
+
+    with open(filename, "r") as f: lines = f.read().splitlines()
+    numbered = [(number, line) for number, line in enumerate(lines, start=1) if line.strip()]
+
+    tokens = ",".join(line for _, line in numbered).split(",")
+    if len(tokens) == 4 * len(numbered) and all(line.count(",") == 3 for _, line in numbered):
+        try: return np.array(tokens, dtype=float).reshape(-1, 4).T
+        except ValueError: pass
+    # fast path: all lines have 4 fields that convert to float
+
+    rows = []
+    for number, line in numbered:
+        fields = line.split(",")
+        try:
+            if len(fields) != 4: raise ValueError
+            rows.append([float(field) for field in fields])
+        except ValueError:
+            raise ValueError(f"{filename}, line {number}: expected 4 comma-separated numbers x,y,z,I, got '{line}'") from None
+    return np.array(rows, dtype=float).reshape(-1, 4).T
+    # slow path, line by line to report the first malformed line
+
+def write_coil_sidecar(filename):
     '''
-    with open(filename, "r") as f: return np.array([[eval(i) for i in line.split(",")] for line in f.read().splitlines()]).T
+    Parses the coil in filename once and stores it as a binary sidecar next to it,
+    so that later calls of parse_coil load it without parsing the text.
+
+    Returns the parsed coil
+    '''
+    coil = parse_coil(filename, sidecar=False)
+    with open(coil_sidecar(filename), "wb") as f: np.save(f, coil)
+    return coil
 
 def slice_coil(coil, steplength):
     '''
@@ -43,93 +89,761 @@ def slice_coil(coil, steplength):
 
     If the coil is already sliced into pieces smaller than that, this does nothing.
     '''
-    def interpolate_points(p1, p2, parts):
-        '''
-        Produces a series of linearly spaced points between two given points in R3+I
+    coil = np.asarray(coil, dtype=float)
+    return slice_coils(coil, [0, coil.shape[1]], steplength)[0]
 
-        Linearly interpolates X,Y,Z; but keeps I the SAME
+def slice_coils(coils, offsets, steplength):
+    '''
+    Slices a batch of coils into pieces of size steplength, in time linear in the number of resulting pieces.
 
-        i.e. (0, 2, 1, 3), (3, 4, 2, 5), parts = 2:
-        (0, 2, 1, 3), (1.5, 3, 1.5, 3), (3, 4, 2, 5)
-        '''
-        return np.column_stack((np.linspace(p1[0], p2[0], parts+1), np.linspace(p1[1], p2[1], parts+1),
-                np.linspace(p1[2], p2[2], parts+1), p1[3] * np.ones((parts+1))))
+    coils: All coils concatenated into one (4, N) array, coil g owns the columns offsets[g]:offsets[g+1]
+    offsets: Column boundaries of the coils (length n_coils + 1)
+    steplength: Maximum length of a piece
 
-    newcoil = np.zeros((1, 4)) # fill column with dummy data, we will remove this later.
+    Every segment is interpolated linearly in X,Y,Z from its start to its end vertex, keeping the current
+    of its start vertex, and every sliced coil is forced to have an even number of segments
+    (an odd number of points) for Richardson Extrapolation to work.
 
-    segment_starts = coil[:,:-1]
-    segment_ends = coil[:,1:]
+    Returns (sliced coils concatenated into one (4, M) array, their offsets)
+    '''
+    coils = np.asarray(coils, dtype=float)
+    offsets = np.asarray(offsets, dtype=int)
+
+    segment_starts = coils[:,:-1]
+    segment_ends = coils[:,1:]
     # determine start and end of each segment
 
-    segments = segment_ends-segment_starts
-    segment_lengths = np.apply_along_axis(np.linalg.norm, 0, segments)
+    segments = segment_ends[:3]-segment_starts[:3]
+    segment_lengths = np.linalg.norm(segments, axis=0)
     # create segments; determine start and end of each segment, as well as segment lengths
 
-    # chop up into smaller bits (elements)
+    valid = np.ones(segments.shape[1], dtype=bool)
+    valid[offsets[1:-1] - 1] = False
+    # segments between the last vertex of a coil and the first vertex of the next one do not exist
+
+    stepnumbers = np.where(valid, (segment_lengths/steplength).astype(int), -1)
+    # determine how many steps we must chop each segment into; each segment yields stepnumbers+1 points
+
+    counts = stepnumbers + 1
+    segment = np.repeat(np.arange(len(counts)), counts)
+    k = np.arange(len(segment)) - np.repeat(np.cumsum(counts) - counts, counts)
+    # segment and step index k = 0..stepnumbers of every new point
+
+    parts = np.maximum(stepnumbers[segment], 1)
+    newcoil = np.empty((4, len(segment)))
+    newcoil[:3] = k * (segments[:, segment] / parts) + segment_starts[:3, segment]
+    last = (k == stepnumbers[segment]) & (k > 0)
+    newcoil[:3, last] = segment_ends[:3, segment[last]]
+    newcoil[3] = segment_starts[3, segment]
+    # same points as np.linspace(start, end, stepnumbers+1), current of the start vertex
+
+    coil_of_segment = np.searchsorted(offsets, np.arange(len(counts)), side='right') - 1
+    points_per_coil = np.bincount(coil_of_segment[valid], weights=counts[valid], minlength=len(offsets) - 1).astype(int)
+    new_offsets = np.concatenate(([0], np.cumsum(points_per_coil)))
+
+    even = (points_per_coil % 2 == 0) & (points_per_coil > 0)
+    if even.any():
+        ends = new_offsets[1:][even]
+        newcoil = np.insert(newcoil, ends, newcoil[:, ends - 1], axis=1)
+        new_offsets = np.concatenate(([0], np.cumsum(points_per_coil + even)))
+    ## Force every coil to have an even number of segments, for Richardson Extrapolation to work
+
+    return newcoil, new_offsets
+
+FACTOR = 0.1 # = mu_0 / 4pi when lengths are in cm, and B-field is in G
+
+DEFAULT_MAX_BYTES = 2**20
+# default scratch memory budget of the field engines (1 MiB, small enough to stay in cache)
+
+AXES = 'xyz'
+# names of the grid axes, in the order a target volume is indexed
+
+def _as_points(x, y, z):
+    '''
+    Flattens broadcastable x, y, z arrays into an (N, 3) array of evaluation points.
+
+    The points are ordered such that reshaping a (N, 3) result to shape[::-1] + (3,) gives
+    the same axis order the field routines have always returned, i.e. a (nz, ny, nx) meshgrid
+    from produce_target_volume yields a field indexed as [x, y, z, component].
+    '''
+    x, y, z = np.broadcast_arrays(np.asarray(x, dtype=float), np.asarray(y, dtype=float), np.asarray(z, dtype=float))
+    points = np.column_stack((x.ravel(order='F'), y.ravel(order='F'), z.ravel(order='F')))
+    return points, x.shape[::-1] + (3,)
+
+def _richardson_elements(coil):
+    '''
+    Expands a sliced coil into the midpoint elements of the Richardson extrapolated midpoint rule.
+
+    Every (start, mid, end) triple of the coil contributes three elements:
+    start->end with weight -1/3, start->mid and mid->end with weight 4/3,
+    each weighted by the current of its first vertex.
+
+    Returns (centres, dl, weights) with shapes (K, 3), (K, 3), (K,)
+    '''
+    starts, mids, ends = coil[:,:-1:2], coil[:,1::2], coil[:,2::2]
+    n = ends.shape[1]
+    starts, mids = starts[:,:n], mids[:,:n]
 
-    stepnumbers = (segment_lengths/steplength).astype(int)
-    # determine how many steps we must chop each segment into
+    first = np.concatenate((starts, starts, mids), axis=1)
+    second = np.concatenate((ends, mids, ends), axis=1)
+    coefficients = np.repeat([-1/3, 4/3, 4/3], n)
 
-    for i in range(segments.shape[1]):
-        newrows = interpolate_points(segment_starts[:,i], segment_ends[:,i], stepnumbers[i])
-        # set of new interpolated points to feed in
-        newcoil = np.vstack((newcoil, newrows))
+    centres = ((first[:3] + second[:3]) / 2).T
+    dl = (second[:3] - first[:3]).T
+    weights = coefficients * first[3]
+    return np.ascontiguousarray(centres), np.ascontiguousarray(dl), weights
 
-    if newcoil.shape[0] %2 != 0: newcoil = np.vstack((newcoil, newcoil[-1,:]))
-    ## Force the coil to have an even number of segments, for Richardson Extrapolation to work
+def _block_sizes(n_sources, n_points, bytes_per_pair, max_bytes):
+    '''
+    Chooses (source block, point block) sizes s.t. one block of pairwise temporaries fits into max_bytes.
+    Prefers covering all sources at once, so that every point block is visited only once.
+    '''
+    pairs = max(1, int(max_bytes) // bytes_per_pair)
+    point_block = min(n_points, max(1, pairs // max(1, n_sources)))
+    point_block = max(point_block, min(n_points, 64))
+    source_block = min(n_sources, max(1, pairs // point_block))
+    return max(1, source_block), max(1, point_block)
 
-    return newcoil[1:,:].T # return non-dummy columns
+def _group_ranges(offsets, s0, s1):
+    '''
+    Yields (group, start, end) for every group of sources overlapping the source block [s0, s1).
+    Group g owns the sources offsets[g]:offsets[g+1].
+    '''
+    first = np.searchsorted(offsets, s0, side='right') - 1
+    for g in range(first, len(offsets) - 1):
+        if offsets[g] >= s1: break
+        start, end = max(offsets[g], s0), min(offsets[g+1], s1)
+        if end > start: yield g, start, end
 
-def calculate_field(coil, x, y, z):
+class _Accumulator:
+    '''
+    Running sums of block results. In float64 a plain sum; in lower precision a Kahan compensated sum,
+    so that the rounding error does not grow with the number of source blocks.
+    '''
+    def __init__(self, shape, dtype):
+        self.total = np.zeros(shape, dtype=dtype)
+        self.compensation = np.zeros(shape, dtype=dtype) if np.dtype(dtype) != np.float64 else None
+
+    def add(self, index, value):
+        if self.compensation is None:
+            self.total[index] += value
+            return
+        y = value - self.compensation[index]
+        t = self.total[index] + y
+        self.compensation[index] = (t - self.total[index]) - y
+        self.total[index] = t
+
+def _sum_elements(centres, dl, weights, points, max_bytes=DEFAULT_MAX_BYTES, offsets=None, dtype=np.float64):
+    '''
+    Sums the midpoint Biot-Savart contributions w * dl x (r - c) / |r - c|^3 of all elements at all points.
+
+    Works on blocks of sources x points whose temporaries fit into max_bytes; the scratch buffers are
+    allocated once and reused for every block.
+    offsets: optional group boundaries (length G+1); the elements offsets[g]:offsets[g+1] are summed separately
+    dtype: Precision of the computation. Below float64 the positions are taken relative to the coil,
+        and the sums over sources are pairwise within a block (BLAS) and compensated across blocks
+
+    Returns an (N, 3) array, or (G, N, 3) if offsets are given (without the mu_0 / 4pi FACTOR)
+    '''
+    n_sources, n_points = centres.shape[0], points.shape[0]
+    grouped = offsets is not None
+    offsets = np.asarray(offsets) if grouped else np.array([0, n_sources])
+    B = _Accumulator((len(offsets) - 1, n_points, 3), dtype)
+    if n_sources == 0 or n_points == 0: return B.total if grouped else B.total[0]
+
+    dtype = np.dtype(dtype)
+    source_block, point_block = _block_sizes(n_sources, n_points, 5 * dtype.itemsize, max_bytes)
+    buffers = np.empty((5, source_block * point_block), dtype=dtype)
+
+    wdl = (dl * weights[:, None]).astype(dtype, copy=False)
+    if dtype != np.float64:
+        origin = centres.mean(axis=0)
+        centres, points = (centres - origin).astype(dtype), (points - origin).astype(dtype)
+    # relative to the coil, so that single precision keeps the resolution of small offsets
+
+    for p0 in range(0, n_points, point_block):
+        p1 = min(p0 + point_block, n_points)
+        px, py, pz = points[p0:p1, 0], points[p0:p1, 1], points[p0:p1, 2]
+        for s0 in range(0, n_sources, source_block):
+            s1 = min(s0 + source_block, n_sources)
+            shape = (s1 - s0, p1 - p0)
+            size = shape[0] * shape[1]
+            rx, ry, rz, inv, tmp = (buf[:size].reshape(shape) for buf in buffers)
+
+            np.subtract(px[None, :], centres[s0:s1, 0, None], out=rx)
+            np.subtract(py[None, :], centres[s0:s1, 1, None], out=ry)
+            np.subtract(pz[None, :], centres[s0:s1, 2, None], out=rz)
+            # relative position vectors
+
+            np.multiply(rx, rx, out=inv)
+            np.multiply(ry, ry, out=tmp)
+            inv += tmp
+            np.multiply(rz, rz, out=tmp)
+            inv += tmp
+            # squared distance
+
+            zero = inv == 0
+            inv[zero] = 1
+            np.sqrt(inv, out=tmp)
+            inv *= tmp
+            np.divide(1, inv, out=inv)
+            inv[zero] = 0
+            # 1/|r|^3, points on top of an element get no contribution (like before, dl x 0 = 0)
+
+            rx *= inv
+            ry *= inv
+            rz *= inv
+
+            for g, a, b in _group_ranges(offsets, s0, s1):
+                w, qx, qy, qz = wdl[a:b], rx[a-s0:b-s0], ry[a-s0:b-s0], rz[a-s0:b-s0]
+                B.add((g, slice(p0, p1), 0), w[:, 1] @ qz - w[:, 2] @ qy)
+                B.add((g, slice(p0, p1), 1), w[:, 2] @ qx - w[:, 0] @ qz)
+                B.add((g, slice(p0, p1), 2), w[:, 0] @ qy - w[:, 1] @ qx)
+            # dl x r, summed over the sources of this block as matrix-vector products
+
+    return B.total if grouped else B.total[0]
+
+def calculate_field(coil, x, y, z, max_bytes=DEFAULT_MAX_BYTES, dtype=np.float64):
     '''
     Calculates magnetic field vector as a result of some position and current x, y, z, I
     [In the same coordinate system as the coil]
 
     Coil: Input Coil Positions, already sub-divided into small pieces using slice_coil
     x, y, z: position in cm
+    max_bytes: Upper bound for the scratch memory used per block of (coil pieces x positions)
+    dtype: np.float32 computes in single precision (half the memory traffic), see volume_precision for its error
     
     Output B-field is a 3-D vector in units of G
     '''
-    FACTOR = 0.1 # = mu_0 / 4pi when lengths are in cm, and B-field is in G
+    # midpoint integration with 1 layer of Richardson Extrapolation,
+    # evaluated for blocks of coil pieces x positions at once
+    points, shape = _as_points(x, y, z)
+    centres, dl, weights = _richardson_elements(np.asarray(coil, dtype=float))
 
-    def bs_integrate(start, end):
-        '''
-        Produces tiny segment of magnetic field vector (dB) using the midpoint approximation over some interval
+    B = _sum_elements(centres, dl, weights, points, max_bytes, dtype=dtype)
 
-        TODO for future optimization: Get this to work with meshgrids directly
-        '''
-        dl = (end-start).T
-        mid = (start+end)/2
-        position = np.array((x-mid[0], y-mid[1], z-mid[2])).T
-        # relative position vector
-        mag = np.sqrt((x-mid[0])**2 + (y-mid[1])**2 + (z-mid[2])**2)
-        # magnitude of the relative position vector
+    return (B * FACTOR).reshape(shape) # return (Bx, By, Bz) for every position; indexed [x, y, z, component] when evaluated using produce_target_volume
 
-        arr = np.array((mag ** 3, mag ** 3, mag ** 3)).T
-        # invalid value handling
-        arr[np.isnan(arr)] = 1
-        arr[np.isinf(arr)] = 1
-        arr[arr == 0] = 1
+def _sum_planar_elements(centres, dl, weights, columns, levels, max_bytes=DEFAULT_MAX_BYTES, dtype=np.float64):
+    '''
+    Sums the midpoint contributions of elements parallel to the x-y plane at every (x, y) column and z level.
 
-        return start[3] * np.cross(dl[:3], position) / arr
-        # Apply the Biot-Savart Law to get the differential magnetic field
-        # current flowing in this segment is represented by start[3]
+    With dl = (a, b, 0), the in-plane offset (rx, ry) of a column and the height h = z - c_z of a level,
+        dl x r = (b h, -a h, a ry - b rx),    |r|^2 = rx^2 + ry^2 + h^2
+    so rx^2 + ry^2 and a ry - b rx are computed once per (element, column) pair, and every level only adds h^2,
+    takes the power and applies the weights (B_x and B_y as matrix-vector products).
 
-    B = 0
+    columns: (C, 2) x, y of the columns, levels: (L,) z of the levels
+    dtype: Precision of the computation, see _sum_elements
 
-    # midpoint integration with 1 layer of Richardson Extrapolation
-    starts, mids, ends = coil[:,:-1:2], coil[:,1::2], coil[:,2::2]
+    Returns an (L, C, 3) array (without the mu_0 / 4pi FACTOR)
+    '''
+    n_sources, n_columns = centres.shape[0], columns.shape[0]
+    B = _Accumulator((len(levels), n_columns, 3), dtype)
+    if n_sources == 0 or n_columns == 0: return B.total
+
+    dtype = np.dtype(dtype)
+    source_block, column_block = _block_sizes(n_sources, n_columns, 4 * dtype.itemsize, max_bytes)
+    buffers = np.empty((4, source_block * column_block), dtype=dtype)
+
+    wdl = (dl * weights[:, None]).astype(dtype, copy=False)
+    origin = centres.mean(axis=0) if dtype != np.float64 else np.zeros(3)
+    centres, columns, levels = (centres - origin).astype(dtype), (columns - origin[:2]).astype(dtype), (levels - origin[2]).astype(dtype)
+    # relative to the coil in single precision, see _sum_elements
+
+    for c0 in range(0, n_columns, column_block):
+        c1 = min(c0 + column_block, n_columns)
+        cx, cy = columns[c0:c1, 0], columns[c0:c1, 1]
+        for s0 in range(0, n_sources, source_block):
+            s1 = min(s0 + source_block, n_sources)
+            shape = (s1 - s0, c1 - c0)
+            size = shape[0] * shape[1]
+            rho2, cross, inv, tmp = (buf[:size].reshape(shape) for buf in buffers)
+
+            np.subtract(cx[None, :], centres[s0:s1, 0, None], out=inv)
+            np.subtract(cy[None, :], centres[s0:s1, 1, None], out=tmp)
+            np.multiply(tmp, wdl[s0:s1, 0, None], out=cross)
+            cross -= inv * wdl[s0:s1, 1, None]
+            # w (a ry - b rx)
+            inv *= inv
+            tmp *= tmp
+            np.add(inv, tmp, out=rho2)
+            # in-plane squared distance, shared by all levels
+
+            for l, z in enumerate(levels):
+                h = z - centres[s0:s1, 2]
+                np.add(rho2, (h * h)[:, None], out=inv)
+                zero = inv == 0 if (h == 0).any() else None
+                if zero is not None: inv[zero] = 1
+                np.sqrt(inv, out=tmp)
+                inv *= tmp
+                np.divide(1, inv, out=inv)
+                if zero is not None: inv[zero] = 0
+                # 1/|r|^3, points on top of an element get no contribution as in _sum_elements
+
+                B.add((l, slice(c0, c1), 0), (wdl[s0:s1, 1] * h) @ inv)
+                B.add((l, slice(c0, c1), 1), -(wdl[s0:s1, 0] * h) @ inv)
+                B.add((l, slice(c0, c1), 2), np.einsum('ij,ij->j', cross, inv))
+
+    return B.total
+
+def calculate_planar_field(coil, x, y, z, max_bytes=DEFAULT_MAX_BYTES, dtype=np.float64):
+    '''
+    Calculates magnetic field vector as a result of some position and current x, y, z, I
+    for a coil whose segments are all parallel to the x-y plane (every coil of main.main), see _sum_planar_elements.
+    Gives the result of calculate_field; the in-plane geometry is reused for all z levels of the same (x, y) column.
 
-    for start, mid, end in np.nditer([starts, mids, ends], flags=['external_loop'], order='F'):
-        # use numpy fast indexing
-        fullpart = bs_integrate(start, end) # stage 1 richardson
-        halfpart = bs_integrate(start, mid) + bs_integrate(mid, end) # stage 2 richardson
+    Coil: Input Coil Positions, already sub-divided into small pieces using slice_coil, all segments parallel to x-y
+    x, y, z: position in cm, fastest when they form a grid with many z levels (scattered points fall back to calculate_field)
+    dtype: np.float32 computes in single precision, see calculate_field
 
-        B += 4/3 * halfpart - 1/3 * fullpart # richardson extrapolated midpoint rule
-    
-    return B * FACTOR # return SUM of all components as 3 (x,y,z) meshgrids for (Bx, By, Bz) component when evaluated using produce_target_volume
+    Output B-field is a 3-D vector in units of G, in the same layout as calculate_field
+    '''
+    import fft_util
+    coil = np.asarray(coil, dtype=float)
+    if not fft_util.is_planar(coil): raise ValueError("the planar engine needs a coil whose segments are all parallel to the x-y plane")
+    points, shape = _as_points(x, y, z)
+    centres, dl, weights = _richardson_elements(coil)
+
+    levels, level_index = np.unique(points[:, 2], return_inverse=True)
+    columns, column_index = np.unique(points[:, :2], axis=0, return_inverse=True)
+    if len(levels) * len(columns) > 2 * len(points):
+        B = _sum_elements(centres, dl, weights, points, max_bytes, dtype=dtype)
+    else:
+        B = _sum_planar_elements(centres, dl, weights, columns, levels, max_bytes, dtype)[level_index.ravel(), column_index.ravel()]
+    # points that are not (close to) a grid of columns and levels would cost more as one
+
+    return (B * FACTOR).reshape(shape)
+
+def _sum_segments(starts, ends, currents, points, max_bytes=DEFAULT_MAX_BYTES, offsets=None, dtype=np.float64):
+    '''
+    Sums the exact fields of finite straight current segments at all points.
+
+    For a segment P1 -> P2 and R1 = r - P1, R2 = r - P2 the field is
+        I * (R1 x R2) * (|R1| + |R2|) / (|R1| |R2| (|R1| |R2| + R1.R2))
+    R1 x R2 = L x r + P1 x P2 (L = P2 - P1) is linear in r, so only the scalar factor is
+    computed per (segment, point) pair; the cross product is applied by one matrix product per block.
+    Points on a segment (or its extension) get no contribution from it.
+    offsets: optional group boundaries (length G+1); the segments offsets[g]:offsets[g+1] are summed separately
+    dtype: Precision of the computation, see _sum_elements
+
+    Returns an (N, 3) array, or (G, N, 3) if offsets are given (without the mu_0 / 4pi FACTOR)
+    '''
+    n_sources, n_points = starts.shape[0], points.shape[0]
+    grouped = offsets is not None
+    offsets = np.asarray(offsets) if grouped else np.array([0, n_sources])
+    B = _Accumulator((len(offsets) - 1, n_points, 3), dtype)
+    if n_sources == 0 or n_points == 0: return B.total if grouped else B.total[0]
+
+    origin = starts.mean(axis=0)
+    starts, ends, points = starts - origin, ends - origin, points - origin
+    # work relative to the coil to avoid cancellation in L x r + P1 x P2
+
+    L = ends - starts
+    LL = np.einsum('ij,ij->i', L, L)
+    V = np.hstack((L, np.cross(starts, ends))) * currents[:, None] # (S, 6)
+
+    dtype = np.dtype(dtype)
+    starts, L, LL, V, points = (a.astype(dtype, copy=False) for a in (starts, L, LL, V, points))
+    source_block, point_block = _block_sizes(n_sources, n_points, 6 * dtype.itemsize, max_bytes)
+    buffers = np.empty((6, source_block * point_block), dtype=dtype)
+    tiny = 1e-12 if dtype == np.float64 else 16 * np.finfo(dtype).eps
+    # 1 + cos of the angle between R1 and R2 below which a point counts as on the segment
+
+    for p0 in range(0, n_points, point_block):
+        p1 = min(p0 + point_block, n_points)
+        P = points[p0:p1]
+        for s0 in range(0, n_sources, source_block):
+            s1 = min(s0 + source_block, n_sources)
+            shape = (s1 - s0, p1 - p0)
+            size = shape[0] * shape[1]
+            rx, ry, rz, d, r1, r2 = (buf[:size].reshape(shape) for buf in buffers)
+
+            np.subtract(P[None, :, 0], starts[s0:s1, 0, None], out=rx)
+            np.subtract(P[None, :, 1], starts[s0:s1, 1, None], out=ry)
+            np.subtract(P[None, :, 2], starts[s0:s1, 2, None], out=rz)
+            # R1 = r - P1
+
+            np.multiply(rx, L[s0:s1, 0, None], out=d)
+            d += ry * L[s0:s1, 1, None]
+            d += rz * L[s0:s1, 2, None]
+            # R1.L
+
+            rx *= rx
+            ry *= ry
+            rz *= rz
+            np.add(rx, ry, out=r1)
+            r1 += rz
+            # |R1|^2
+
+            np.multiply(d, -2, out=r2)
+            r2 += r1
+            r2 += LL[s0:s1, None]
+            np.maximum(r2, 0, out=r2)
+            # |R2|^2 = |R1|^2 - 2 R1.L + |L|^2
+
+            np.subtract(r1, d, out=d)
+            # R1.R2 = |R1|^2 - R1.L
+
+            np.sqrt(r1, out=r1)
+            np.sqrt(r2, out=r2)
+            np.multiply(r1, r2, out=rx)
+            np.add(rx, d, out=ry)
+            ry *= rx
+            np.add(r1, r2, out=rz)
+            # rx = |R1||R2|, ry = |R1||R2| (|R1||R2| + R1.R2), rz = |R1| + |R2|
+
+            singular = ry <= tiny * rx * rx
+            ry[singular] = 1
+            np.divide(rz, ry, out=rz)
+            rz[singular] = 0
+            # scalar factor, zero on the segment itself
+
+            for g, a, b in _group_ranges(offsets, s0, s1):
+                M = V[a:b].T @ rz[a-s0:b-s0] # (6, P): L and P1 x P2 weighted by the factor
+                B.add((g, slice(p0, p1), 0), P[:, 2] * M[1] - P[:, 1] * M[2] + M[3])
+                B.add((g, slice(p0, p1), 1), P[:, 0] * M[2] - P[:, 2] * M[0] + M[4])
+                B.add((g, slice(p0, p1), 2), P[:, 1] * M[0] - P[:, 0] * M[1] + M[5])
+
+    return B.total if grouped else B.total[0]
+
+def _straight_segments(coil):
+    '''
+    Splits a coil into its straight segments between consecutive vertices.
+    Returns (starts, ends, currents) with shapes (S, 3), (S, 3), (S,)
+    '''
+    return np.ascontiguousarray(coil[:3,:-1].T), np.ascontiguousarray(coil[:3,1:].T), coil[3,:-1]
+
+def calculate_segment_field(coil, x, y, z, max_bytes=DEFAULT_MAX_BYTES, dtype=np.float64):
+    '''
+    Calculates magnetic field vector as a result of some position and current x, y, z, I
+    [In the same coordinate system as the coil]
+
+    Uses the exact field of a finite straight segment for every pair of consecutive coil vertices,
+    so the coil does not need to be sliced with slice_coil (slicing it does not change the result).
+
+    Coil: Input Coil Positions in format specified above
+    x, y, z: position in cm
+    max_bytes: Upper bound for the scratch memory used per block of (segments x positions)
+    dtype: np.float32 computes in single precision, see calculate_field
+
+    Output B-field is a 3-D vector in units of G, in the same layout as calculate_field
+    '''
+    points, shape = _as_points(x, y, z)
+
+    B = _sum_segments(*_straight_segments(np.asarray(coil, dtype=float)), points, max_bytes, dtype=dtype)
+
+    return (B * FACTOR).reshape(shape)
+
+def calculate_tree_field(coil, x, y, z, max_bytes=DEFAULT_MAX_BYTES, tolerance=1e-3, leaf_size=32, stats=None):
+    '''
+    Calculates magnetic field vector as a result of some position and current x, y, z, I
+    with the Barnes-Hut method, see tree_util.calculate_tree_field.
+
+    Coil: Input Coil Positions, already sub-divided into small pieces using slice_coil (or a tree_util.SegmentTree)
+    x, y, z: position in cm
+    tolerance: Relative accuracy of the multipole expansions compared to the direct sum of calculate_field
+    leaf_size: Maximum number of coil pieces in a leaf of the octree
+    stats: Optional dict, receives the interaction counts of tree_util.calculate_tree_field
+        (produce_target_volume sums them over all slabs)
+    '''
+    import tree_util
+    return tree_util.calculate_tree_field(coil, x, y, z, max_bytes, tolerance=tolerance, leaf_size=leaf_size, stats=stats)
+
+def calculate_fft_field(coil, x, y, z, max_bytes=DEFAULT_MAX_BYTES):
+    '''
+    Calculates magnetic field vector as a result of some position and current x, y, z, I
+    by FFT convolution of the rasterized current, see fft_util.calculate_fft_field.
+
+    Coil: Input Coil Positions, all segments parallel to the x-y plane (sliced or not)
+    x, y, z: positions in cm forming a regular grid
+    Accurate beyond a few grid spacings from the copper only, see fft_util.
+    '''
+    import fft_util
+    return fft_util.calculate_fft_field(coil, x, y, z, max_bytes)
+
+def calculate_multipole_field(coil, x, y, z, max_bytes=DEFAULT_MAX_BYTES, tolerance=1e-3, stats=None):
+    '''
+    Calculates magnetic field vector as a result of some position and current x, y, z, I
+    from the multipole expansion of the whole coil far from it, see multipole_util.calculate_multipole_field.
+
+    Coil: Input Coil Positions, already sub-divided into small pieces using slice_coil (or a multipole_util.CoilExpansion)
+    x, y, z: position in cm
+    tolerance: Relative accuracy of the expansion compared to calculate_field, nearer points use calculate_field
+    stats: Optional dict, receives the counts of multipole_util.calculate_multipole_field
+        (produce_target_volume sums them over all slabs)
+    '''
+    import multipole_util
+    return multipole_util.calculate_multipole_field(coil, x, y, z, max_bytes, tolerance=tolerance, stats=stats)
+
+def calculate_gauss_field(coil, x, y, z, max_bytes=DEFAULT_MAX_BYTES, tolerance=1e-6, stats=None):
+    '''
+    Calculates magnetic field vector as a result of some position and current x, y, z, I
+    by Gauss-Legendre quadrature with an order per (segment, position) pair, see quadrature_util.calculate_gauss_field.
+
+    Coil: Input Coil Positions in format specified above (no need to slice it)
+    x, y, z: position in cm
+    tolerance: Relative accuracy of the integral of every (segment, position) pair
+    stats: Optional dict, receives the counts and error estimate of quadrature_util.calculate_gauss_field
+        (produce_target_volume sums the counts over all slabs and keeps the largest error)
+    '''
+    import quadrature_util
+    return quadrature_util.calculate_gauss_field(coil, x, y, z, max_bytes, tolerance=tolerance, stats=stats)
+
+def calculate_separable_field(coil, x, y, z, max_bytes=DEFAULT_MAX_BYTES, dtype=np.float64, stats=None):
+    '''
+    Calculates magnetic field vector as a result of some position and current x, y, z, I
+    exactly like calculate_segment_field, with the segments parallel to a coordinate axis evaluated from
+    per-axis tables of the grid, see separable_util.calculate_separable_field.
+
+    Coil: Input Coil Positions in format specified above (no need to slice it, or a separable_util.AlignedSegments)
+    x, y, z: position in cm, a regular grid (other positions are summed like calculate_segment_field)
+    dtype: np.float32 computes in single precision, see calculate_field
+    stats: Optional dict, receives the segment counts of separable_util.calculate_separable_field
+    '''
+    import separable_util
+    return separable_util.calculate_separable_field(coil, x, y, z, max_bytes, dtype, stats)
+
+def _prepare_tree(coil, leaf_size=32, **engine_options):
+    import tree_util
+    return tree_util.SegmentTree(coil, leaf_size), engine_options
+
+def _prepare_multipole(coil, **engine_options):
+    import multipole_util
+    return multipole_util.CoilExpansion(coil), engine_options
+
+def _prepare_separable(coil, **engine_options):
+    import separable_util
+    return separable_util.AlignedSegments(coil), engine_options
+
+ENGINES = {
+    'midpoint': calculate_field,
+    'planar': calculate_planar_field,
+    'segment': calculate_segment_field,
+    'tree': calculate_tree_field,
+    'fft': calculate_fft_field,
+    'multipole': calculate_multipole_field,
+    'gauss': calculate_gauss_field,
+    'separable': calculate_separable_field,
+}
+# field engines selectable in produce_target_volume and write_target_volume
+# midpoint: Richardson extrapolated midpoint rule, the coil has to be sliced with slice_coil first
+# planar: midpoint for coils parallel to the x-y plane, reusing the in-plane terms for all z levels of a column
+# segment: exact field of straight segments, works on the unsliced coil
+# tree: Barnes-Hut approximation of midpoint (options: tolerance, leaf_size)
+# fft: FFT convolution for planar coils on regular grids, inaccurate within a few grid spacings of the copper
+# gauss: adaptive Gauss-Legendre quadrature along every segment, works on the unsliced coil (options: tolerance)
+# multipole: expansion of the whole coil far from it, midpoint near it (options: tolerance), for boxes much larger than the coil
+# separable: segment, with the segments parallel to an axis evaluated from per-axis tables of the grid (square coils)
+# 'auto' picks separable for coils with at least separable_util.SEPARABLE_FRACTION (half) of the merged segments axis-aligned
+# (square coils, and the octagons of main.main), else fft for planar coils on grids with at least
+# FFT_MIN_POINTS points whose z levels are all at least FFT_MIN_DISTANCE grid spacings from the layers of the coil,
+# planar for other planar coils, midpoint otherwise. Engines that do not take the given engine options are skipped
+
+FFT_MIN_POINTS = 1_000_000
+FFT_MIN_DISTANCE = 3
+# in x-y grid spacings, closer to the copper the rasterization error of fft is of the order of the field
+
+def _fft_clearance(coil, axes):
+    '''
+    Returns the smallest distance of the z levels in axes from the layers of a planar coil, in x-y grid spacings.
+    '''
+    import fft_util
+    spacing = max([float(np.diff(axis).max()) for axis in axes[:2] if len(axis) > 1], default=0.0)
+    levels = np.array([layer[0] for layer in fft_util.planar_layers(coil)])
+    if spacing == 0 or not len(levels) or not len(axes[2]): return np.inf
+    return float(np.abs(np.asarray(axes[2])[:, None] - levels[None, :]).min()) / spacing
+
+def _takes_options(engine, engine_options):
+    # True if the function of engine has a parameter for every option
+    parameters = inspect.signature(ENGINES[engine]).parameters
+    return all(option in parameters for option in engine_options)
+
+def _resolve_engine(engine, coil, axes, tile=None, engine_options=()):
+    '''
+    Returns the engine to use for a target volume on the grid spanned by axes (x, y, z coordinates), resolving 'auto'.
+    tile: (x, y, z) number of grid points evaluated at once, if not the whole grid (see produce_target_volume_file)
+    engine_options: Options that will be passed on to the engine, 'auto' only picks engines that take them
+    Raises a ValueError if 'auto' finds no such engine.
+    '''
+    if engine == 'auto':
+        import fft_util, separable_util
+        planar = fft_util.is_planar(coil)
+        if _takes_options('separable', engine_options) and separable_util.is_separable(coil): return 'separable'
+        n_points = int(np.prod(tile if tile is not None else [len(axis) for axis in axes]))
+        if planar and n_points >= FFT_MIN_POINTS and _takes_options('fft', engine_options) \
+                and _fft_clearance(coil, axes) >= FFT_MIN_DISTANCE: return 'fft'
+        for fallback in (['planar'] if planar else []) + ['midpoint']:
+            if _takes_options(fallback, engine_options): return fallback
+        raise ValueError(f"none of the engines 'auto' picks from for this coil takes the options {sorted(engine_options)}, pass engine= explicitly")
+    if engine not in ENGINES: raise ValueError(f"unknown field engine '{engine}', expected one of {list(ENGINES) + ['auto']}")
+    return engine
+
+_PREPARE = {
+    'tree': _prepare_tree,
+    'multipole': _prepare_multipole,
+    'separable': _prepare_separable,
+}
+# engine -> function(coil, **engine_options) returning (what the engine takes as coil, remaining options),
+# so that work that only depends on the coil is done once per target volume instead of once per slab
+
+_STATS_MERGE = {
+    'tree': {'far': operator.add, 'near': operator.add, 'points': operator.add},
+    'multipole': {'far': operator.add, 'near': operator.add, 'switch_distance': min},
+    'gauss': {'evaluations': operator.add, 'pairs': operator.add, 'split': operator.add, 'error': max},
+    'separable': {'aligned': min, 'other': max},
+}
+# engine -> how the stats of two slabs of a target volume combine, per key (other keys take the value of the last slab).
+# separable counts segments, not points: the slabs keep the fewest taken from the tables and the most summed directly
+
+def _merge_stats(stats, slab_stats, engine):
+    '''
+    Merges the stats of one slab into the stats of the volume so far, see _STATS_MERGE.
+    '''
+    rules = _STATS_MERGE.get(engine, {})
+    for key, value in slab_stats.items():
+        stats[key] = rules[key](stats[key], value) if key in rules and key in stats else value
+
+_BATCH_KERNELS = {
+    'midpoint': (_richardson_elements, _sum_elements),
+    'segment': (_straight_segments, _sum_segments),
+}
+# (coil -> sources, summation over sources) of the engines that can evaluate several coils in one pass
+
+def _batch_sources(coils, engine):
+    '''
+    Concatenates the sources of several coils for one pass of a batched kernel.
+    Returns (summation function, concatenated sources, group offsets)
+    '''
+    if engine not in _BATCH_KERNELS: raise ValueError(f"engine '{engine}' cannot evaluate several coils at once, expected one of {list(_BATCH_KERNELS)}")
+    to_sources, kernel = _BATCH_KERNELS[engine]
+
+    parts = [to_sources(np.asarray(coil, dtype=float)) for coil in coils]
+    offsets = np.cumsum([0] + [len(part[-1]) for part in parts])
+    sources = [np.concatenate(arrays) for arrays in zip(*parts)] if parts else [np.zeros((0, 3)), np.zeros((0, 3)), np.zeros(0)]
+    return kernel, sources, offsets
+
+def calculate_fields(coils, x, y, z, max_bytes=DEFAULT_MAX_BYTES, engine='midpoint'):
+    '''
+    Calculates the magnetic field vectors of several coils at the same positions x, y, z in one pass.
+    The distances between every position and the pieces of all coils are computed once per block.
+
+    coils: List of coils in the format specified above (sliced with slice_coil for the 'midpoint' engine)
+    x, y, z: position in cm
+    engine: 'midpoint' or 'segment', see ENGINES
+
+    Output: B-fields stacked along a leading coil axis, i.e. (n_coils,) + the layout of calculate_field
+    '''
+    points, shape = _as_points(x, y, z)
+    kernel, sources, offsets = _batch_sources(coils, engine)
+
+    B = kernel(*sources, points, max_bytes, offsets)
+
+    return (B * FACTOR).reshape((len(coils),) + shape)
+
+def calculate_point_field(coil, points, max_bytes=DEFAULT_MAX_BYTES, engine='midpoint', **engine_options):
+    '''
+    Calculates the magnetic field vectors at an arbitrary cloud of positions, e.g. a line, a surface or sensor positions
+    (see points_util for builders). Only the given positions are evaluated.
+
+    Coil: Input Coil Positions in format specified above (sub-divided with slice_coil for the 'midpoint' engine)
+    points: (..., 3) array of positions in cm
+    engine: Name of the field engine in ENGINES, except 'fft' (which needs a regular grid)
+    engine_options: Passed on to the engine, e.g. tolerance for 'tree' or dtype for 'midpoint', 'segment' and 'separable'
+
+    Output B-field has the shape of points, (..., 3) in units of G
+    '''
+    if engine not in ENGINES or engine == 'fft':
+        raise ValueError(f"point clouds need one of {[name for name in ENGINES if name != 'fft']}, not '{engine}'")
+    points = np.asarray(points, dtype=float)
+    if points.shape[-1:] != (3,): raise ValueError(f"points must have shape (..., 3), not {points.shape}")
+    flat = points.reshape(-1, 3)
+
+    coil = np.asarray(coil, dtype=float)
+    if engine in _PREPARE: coil, engine_options = _PREPARE[engine](coil, **engine_options)
+    B = ENGINES[engine](coil, flat[:, 0], flat[:, 1], flat[:, 2], max_bytes, **engine_options)
+
+    return B.reshape(points.shape)
+
+def grid_axes(box_size, start_point, vol_resolution):
+    '''
+    Returns the x, y, z coordinates (in cm) of a target volume grid, incl. end points.
+
+    box_size: (x, y, z) dimensions of the box in cm
+    start_point: (x, y, z) = (0, 0, 0) = bottom left corner position of the box
+    vol_resolution: Spatial resolution (in cm)
+    '''
+    return tuple(np.linspace(start_point[i], box_size[i] + start_point[i], int(box_size[i]/vol_resolution)+1) for i in range(3))
+
+def _slab_field(coil, axes, slab_axis, index, max_bytes, engine, engine_options, stats=None):
+    '''
+    Evaluates one slab (a single plane along slab_axis) of a target volume.
+    Returns the field of the plane, indexed [x, y, z, component] with length 1 along slab_axis.
+    stats: Optional dict, the stats of the engine for this slab are merged into it (see _merge_stats)
+    '''
+    x, y, z = axes
+    if slab_axis == 'z': z = z[index:index+1]
+    else: y = y[index:index+1]
+
+    Z, Y, X = np.meshgrid(z, y, x, indexing='ij')
+    # NOTE: Requires axes to be flipped in order for meshgrid to have the correct dimensional order
+
+    if stats is None: return ENGINES[engine](coil, X,Y,Z, max_bytes, **engine_options)
+    slab_stats = {}
+    field = ENGINES[engine](coil, X,Y,Z, max_bytes, stats=slab_stats, **engine_options)
+    _merge_stats(stats, slab_stats, engine)
+    return field
 
-def produce_target_volume(coil, box_size, start_point, vol_resolution):
+def _slab_index(slab_axis, index):
+    # index of one slab inside a target volume indexed [x, y, z, component]
+    return (slice(None), slice(None), slice(index, index+1)) if slab_axis == 'z' else (slice(None), slice(index, index+1))
+
+def _axes_volume(coil, axes, slab_axis, max_bytes, engine, engine_options, stats=None):
+    '''
+    Evaluates the target volume on the grid spanned by axes slab by slab in this process.
+    stats: Optional dict, receives the stats of the engine merged over all slabs
+    '''
+    if engine in _PREPARE: coil, engine_options = _PREPARE[engine](coil, **engine_options)
+    targetVolume = np.empty(tuple(len(axis) for axis in axes) + (3,), dtype=engine_options.get('dtype', np.float64))
+    merged = {} if stats is not None else None
+    for index in range(len(axes[AXES.index(slab_axis)])):
+        targetVolume[_slab_index(slab_axis, index)] = _slab_field(coil, axes, slab_axis, index, max_bytes, engine, engine_options, merged)
+    if stats is not None: stats.update(merged)
+    return targetVolume
+
+_worker_state = {}
+# per-process state of the produce_target_volume worker pool
+
+def _init_slab_worker(coil_name, coil_shape, volume_name, volume_shape, axes, slab_axis, max_bytes, engine, engine_options, with_stats):
+    '''
+    Attaches a pool worker to the shared coil and target volume.
+    '''
+    from multiprocessing import shared_memory
+
+    coil_shm = shared_memory.SharedMemory(name=coil_name)
+    volume_shm = shared_memory.SharedMemory(name=volume_name)
+    coil = np.ndarray(coil_shape, dtype=float, buffer=coil_shm.buf)
+    if engine in _PREPARE: coil, engine_options = _PREPARE[engine](coil, **engine_options)
+
+    _worker_state.update(
+        shm=(coil_shm, volume_shm), # keep the segments mapped for the lifetime of the worker
+        coil=coil,
+        volume=np.ndarray(volume_shape, dtype=engine_options.get('dtype', np.float64), buffer=volume_shm.buf),
+        args=(axes, slab_axis, max_bytes, engine, engine_options),
+        with_stats=with_stats)
+
+def _run_slab_worker(index):
+    '''
+    Evaluates one slab in a pool worker and writes it straight into the shared target volume.
+    Returns the stats of the engine for the slab, or None if they are not collected.
+    '''
+    axes, slab_axis, max_bytes, engine, engine_options = _worker_state['args']
+    stats = {} if _worker_state['with_stats'] else None
+    _worker_state['volume'][_slab_index(slab_axis, index)] = _slab_field(_worker_state['coil'], axes, slab_axis, index, max_bytes, engine, engine_options, stats)
+    return stats
+
+def produce_target_volume(coil, box_size, start_point, vol_resolution, max_bytes=DEFAULT_MAX_BYTES, engine='auto',
+                          workers=1, slab_axis=None, **engine_options):
     '''
     Generates a set of field vector values for each tuple (x, y, z) in the box.
 ​
@@ -137,20 +851,302 @@ def produce_target_volume(coil, box_size, start_point, vol_resolution):
     box_size: (x, y, z) dimensions of the box in cm
     start_point: (x, y, z) = (0, 0, 0) = bottom left corner position of the box
     vol_resolution: Spatial resolution (in cm)
+    max_bytes: Upper bound for the scratch memory of the field computation (per worker), see calculate_field
+    engine: Name of the field engine in ENGINES ('midpoint', 'planar', 'segment', 'tree', 'fft', 'multipole', 'gauss', 'separable'),
+        or 'auto' (default): 'separable' for coils with at least half of the segments axis-aligned (squares and octagons,
+        see separable_util.SEPARABLE_FRACTION), else for planar coils
+        'fft' on grids with at least FFT_MIN_POINTS points and no z level within FFT_MIN_DISTANCE grid spacings of a layer
+        of the coil, 'planar' for other planar coils and 'midpoint' for the rest (skipping engines that do not take engine_options)
+    workers: Number of processes evaluating the volume. With workers > 1 the coil and the
+        target volume live in shared memory and every worker writes its slabs directly into the volume
+    slab_axis: 'z' or 'y', the volume is evaluated one plane along this axis at a time.
+        Defaults to the one with more planes ('z' for the fft and separable engines, 'y' for the planar engine, whose slabs
+        then hold all z levels). The result does not depend on workers.
+    engine_options: Passed on to the engine, e.g. tolerance for 'tree', or dtype=np.float32 for 'midpoint', 'planar', 'segment' and 'separable'
+        (the volume is then computed and returned in single precision, see volume_precision).
+        A stats dict (for 'tree', 'multipole', 'gauss' and 'separable') receives the stats of the engine merged over all slabs, also with workers > 1
     '''
-    x = np.linspace(start_point[0], box_size[0] + start_point[0],int(box_size[0]/vol_resolution)+1)
-    y = np.linspace(start_point[1], box_size[1] + start_point[1],int(box_size[1]/vol_resolution)+1)
-    z = np.linspace(start_point[2], box_size[2] + start_point[2],int(box_size[2]/vol_resolution)+1)
+    axes = grid_axes(box_size, start_point, vol_resolution)
     # Generate points at regular spacing, incl. end points
-    
-    Z, Y, X = np.meshgrid(z, y, x, indexing='ij')
-    # NOTE: Requires axes to be flipped in order for meshgrid to have the correct dimensional order
+    shape = (len(axes[0]), len(axes[1]), len(axes[2]), 3)
+    engine = _resolve_engine(engine, coil, axes, engine_options=engine_options)
+
+    if slab_axis is None: slab_axis = 'z' if (len(axes[2]) >= len(axes[1]) or engine in ('fft', 'separable')) and engine != 'planar' else 'y'
+    if slab_axis not in ('z', 'y'): raise ValueError(f"slab_axis must be 'z' or 'y', not '{slab_axis}'")
+    slabs = range(len(axes[2]) if slab_axis == 'z' else len(axes[1]))
+
+    coil = np.ascontiguousarray(coil, dtype=float)
+    workers = min(int(workers), len(slabs))
+    stats = engine_options.pop('stats', None)
+    # the engine fills it per slab, the slabs are merged here (see _merge_stats)
+
+    if workers <= 1: return _axes_volume(coil, axes, slab_axis, max_bytes, engine, engine_options, stats)
+
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import shared_memory
+
+    coil_shm = shared_memory.SharedMemory(create=True, size=max(1, coil.nbytes))
+    dtype = np.dtype(engine_options.get('dtype', np.float64))
+    volume_shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * dtype.itemsize)
+    try:
+        np.ndarray(coil.shape, dtype=float, buffer=coil_shm.buf)[...] = coil
+        initargs = (coil_shm.name, coil.shape, volume_shm.name, shape, axes, slab_axis, max_bytes, engine, engine_options, stats is not None)
+
+        merged = {}
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_slab_worker, initargs=initargs) as pool:
+            for slab_stats in pool.map(_run_slab_worker, slabs, chunksize=max(1, len(slabs) // (4 * workers))):
+                if slab_stats is not None: _merge_stats(merged, slab_stats, engine)
+        if stats is not None: stats.update(merged)
+
+        return np.ndarray(shape, dtype=dtype, buffer=volume_shm.buf).copy()
+    finally:
+        coil_shm.close()
+        coil_shm.unlink()
+        volume_shm.close()
+        volume_shm.unlink()
+
+def iter_target_slices(coil, box_size, start_point, vol_resolution, max_bytes=DEFAULT_MAX_BYTES, engine='auto', levels=None, **engine_options):
+    '''
+    Generates the target volume one z plane at a time, yielding (z, field) as soon as a plane is done.
+    Only one plane is held in memory, so consumers can plot or write while the rest is still being computed, e.g.
+
+        volume = create_target_volume(name, box_size, start_point, vol_resolution)
+        for k, (z, field) in enumerate(iter_target_slices(coil, box_size, start_point, vol_resolution)):
+            volume[:, :, k] = field
+
+    Coil, box_size, start_point, vol_resolution, max_bytes, engine, engine_options: see produce_target_volume
+    levels: Optional z values; only the first grid plane >= each level is computed (like plot_fields picks its plane)
+
+    Yields (z in cm, (nx, ny, 3) field indexed [x, y, component])
+    '''
+    axes = grid_axes(box_size, start_point, vol_resolution)
+    engine = _resolve_engine(engine, coil, axes, engine_options=engine_options)
+    coil = np.ascontiguousarray(coil, dtype=float)
+    stats = engine_options.pop('stats', None)
+    merged = {} if stats is not None else None
+    if engine in _PREPARE: coil, engine_options = _PREPARE[engine](coil, **engine_options)
+
+    indices = range(len(axes[2]))
+    if levels is not None:
+        indices = []
+        for level in np.atleast_1d(levels):
+            above = np.nonzero(axes[2] >= level)[0]
+            if not len(above): raise ValueError(f"level {level} is outside the volume along z")
+            indices.append(above[0])
+
+    for index in indices:
+        field = _slab_field(coil, axes, 'z', index, max_bytes, engine, engine_options, merged)[:, :, 0]
+        if stats is not None: stats.update(merged)
+        # merged over the planes yielded so far
+        yield axes[2][index], field
+
+def volume_precision(coil, targetVolume, box_size, start_point, vol_resolution, engine='auto', check_points=64,
+                     max_bytes=DEFAULT_MAX_BYTES, **engine_options):
+    '''
+    Spot-checks a target volume computed in reduced precision against float64 at check_points grid points.
+
+    Coil, box_size, start_point, vol_resolution, engine, engine_options: as used for targetVolume; 'auto' resolves
+        to the engine produce_target_volume picked, with the dtype of targetVolume
+
+    Returns the maximum relative error |B - B64| / |B64| over the check points
+    '''
+    axes = grid_axes(box_size, start_point, vol_resolution)
+    sample = tuple(np.random.default_rng(0).integers(0, len(axis), check_points) for axis in axes)
+    if np.asarray(targetVolume).dtype != np.float64: engine_options.setdefault('dtype', np.asarray(targetVolume).dtype)
+    engine = _resolve_engine(engine, coil, axes, engine_options=engine_options)
+    engine_options.pop('dtype', None)
+    exact = ENGINES[engine](np.asarray(coil, dtype=float), *(axis[i] for axis, i in zip(axes, sample)), max_bytes, **engine_options)
+
+    norm = np.linalg.norm(exact, axis=-1)
+    error = np.linalg.norm(np.asarray(targetVolume)[sample].astype(float) - exact, axis=-1)
+    return float((error[norm > 0] / norm[norm > 0]).max(initial=0))
+
+def produce_target_volumes(coils, box_size, start_point, vol_resolution, max_bytes=DEFAULT_MAX_BYTES, engine='midpoint',
+                           total=False, slab_axis=None):
+    '''
+    Generates the target volumes of several coils on the same grid in one pass.
+
+    coils: List of coils in format specified above (sub-divided with slice_coil for the 'midpoint' engine)
+    box_size, start_point, vol_resolution, max_bytes, slab_axis: see produce_target_volume
+    engine: 'midpoint' or 'segment'
+    total: If True, additionally return the summed field of all coils
+
+    Returns an (n_coils, nx, ny, nz, 3) array, or (fields, total field) if total is set
+    '''
+    kernel, sources, offsets = _batch_sources(coils, engine)
+
+    axes = grid_axes(box_size, start_point, vol_resolution)
+    if slab_axis is None: slab_axis = 'z' if len(axes[2]) >= len(axes[1]) else 'y'
+    if slab_axis not in ('z', 'y'): raise ValueError(f"slab_axis must be 'z' or 'y', not '{slab_axis}'")
+    slabs = range(len(axes[2]) if slab_axis == 'z' else len(axes[1]))
+
+    targetVolumes = np.empty((len(coils), len(axes[0]), len(axes[1]), len(axes[2]), 3))
+    for index in slabs:
+        x, y, z = axes
+        if slab_axis == 'z': z = z[index:index+1]
+        else: y = y[index:index+1]
+        points, shape = _as_points(*np.meshgrid(z, y, x, indexing='ij')[::-1])
+
+        B = kernel(*sources, points, max_bytes, offsets)
+        targetVolumes[(slice(None),) + _slab_index(slab_axis, index)] = (B * FACTOR).reshape((len(coils),) + shape)
+
+    if total: return targetVolumes, targetVolumes.sum(axis=0)
+    return targetVolumes
+
+def nominal_current(coil):
+    '''
+    Returns the drive current of a coil in A: the vertex current of largest magnitude, with its sign.
+    '''
+    currents = np.asarray(coil, dtype=float)[3]
+    return currents[np.argmax(np.abs(currents))]
+
+def produce_unit_fields(coils, box_size, start_point, vol_resolution, max_bytes=DEFAULT_MAX_BYTES, engine='midpoint', slab_axis=None):
+    '''
+    Generates the field of every coil of a layout at a drive current of 1 A, the basis for superpose_fields.
+    Each coil is scaled by its nominal_current, so the polarity drawn in the coil file is kept.
+
+    coils, box_size, start_point, vol_resolution, max_bytes, engine, slab_axis: see produce_target_volumes
 
-    return calculate_field(coil, X,Y,Z)
+    Returns an (n_coils, nx, ny, nz, 3) array in G/A, store it with save_target_volume
+    '''
+    units = []
+    for coil in coils:
+        current = nominal_current(coil)
+        if current == 0: raise ValueError("a coil without current has no unit field")
+        units.append(np.vstack([np.asarray(coil, dtype=float)[:3], np.asarray(coil, dtype=float)[3:] / current]))
+
+    return produce_target_volumes(units, box_size, start_point, vol_resolution, max_bytes, engine, slab_axis=slab_axis)
+
+def superpose_fields(unit_fields, currents):
+    '''
+    Returns the total field of a layout for a vector of coil currents, as the weighted sum of unit-current fields.
+    Fields are linear in the current, so this replaces a Biot-Savart run per drive pattern.
+
+    unit_fields: (n_coils, nx, ny, nz, 3) fields at 1 A, from produce_unit_fields or read_target_volume (memory mapping works)
+    currents: (n_coils,) currents in A, negative values reverse a coil and 0 switches it off,
+        or (n_patterns, n_coils) to get the fields of several drive patterns at once
+
+    Returns an (nx, ny, nz, 3) array, or (n_patterns, nx, ny, nz, 3)
+    '''
+    currents = np.asarray(currents, dtype=float)
+    if currents.shape[-1] != len(unit_fields):
+        raise ValueError(f"{currents.shape[-1]} currents for {len(unit_fields)} unit fields")
+
+    total = np.empty(currents.shape[:-1] + unit_fields.shape[1:])
+    for i in range(unit_fields.shape[1]):
+        total[..., i, :, :, :] = np.tensordot(currents, unit_fields[:, i], axes=(-1, 0))
+    # one x plane at a time, so that a memory mapped basis is streamed instead of loaded
+    return total
+
+LAYOUT_TOLERANCE = 0.02
+# cm, largest vertex mismatch of coils that count as translated copies: main.main writes the vertices rounded to 0.01 cm,
+# so copies placed at different positions differ by up to 0.01 cm per vertex, plus the error of their offset
+
+def translation_groups(coils, tolerance=LAYOUT_TOLERANCE):
+    '''
+    Groups coils whose vertices match up to a translation within tolerance (in cm) and whose currents are identical.
+
+    Returns a list of (indices, offsets, mismatches): the coils of a group, their (x, y, z) translation in cm
+    relative to the first coil of the group (the mean shift of the vertices, offsets[0] = (0, 0, 0))
+    and the largest distance along an axis between a vertex and the shifted vertex of the first coil, in cm
+    '''
+    groups = []
+    for index, coil in enumerate(coils):
+        coil = np.asarray(coil, dtype=float)
+        for first, members in groups:
+            if first.shape != coil.shape or not np.array_equal(first[3:], coil[3:]): continue
+            offset = (coil[:3] - first[:3]).mean(axis=1) if coil.shape[1] else np.zeros(3)
+            mismatch = float(np.abs(coil[:3] - first[:3] - offset[:, None]).max()) if coil.shape[1] else 0.0
+            if mismatch <= tolerance:
+                members.append((index, offset, mismatch))
+                break
+        else:
+            groups.append((coil, [(index, np.zeros(3), 0.0)]))
+
+    return [([index for index, _, _ in members], np.array([offset for _, offset, _ in members]),
+             np.array([mismatch for _, _, mismatch in members])) for _, members in groups]
+
+def produce_layout_volume(coils, box_size, start_point, vol_resolution, max_bytes=DEFAULT_MAX_BYTES, engine='midpoint',
+                          separate=False, check_points=64, stats=None, tolerance=LAYOUT_TOLERANCE, **engine_options):
+    '''
+    Generates the combined target volume of a layout of coils, evaluating coils that are translated copies of
+    each other only once: the field of the first coil of a group is computed on a grid extended by the spread of
+    the offsets, and shifted into place for the others.
+
+    Offsets that are a multiple of vol_resolution are an exact shift of the grid. Other offsets are trilinearly
+    interpolated; their error is measured against the engine at the check_points points with the largest curvature
+    of the field (where interpolation is worst, mostly next to the copper) and reported in stats.
+    Coils read from files are rounded (0.01 cm for main.main), so copies match within tolerance only, and offsets within
+    the vertex mismatch of a whole grid step are taken as one.
+
+    coils: List of coils in format specified above (sub-divided with slice_coil for the 'midpoint' engine)
+    box_size, start_point, vol_resolution, max_bytes, engine_options: see produce_target_volume
+    engine: Name of the field engine in ENGINES
+    separate: If True, return the (n_coils, nx, ny, nz, 3) fields of the coils instead of their sum
+    stats: Optional dict, receives 'groups' (number of field evaluations), 'interpolated',
+        a list of (coil index, offset, max error relative to the peak field of the coil),
+        and 'mismatch', the largest vertex mismatch in cm of a coil placed as a copy (see translation_groups)
+    tolerance: Largest vertex mismatch in cm of coils that count as translated copies, see translation_groups
+
+    Returns the (nx, ny, nz, 3) total field, or the fields of the coils if separate is set
+    '''
+    axes = grid_axes(box_size, start_point, vol_resolution)
+    shape = tuple(len(axis) for axis in axes)
+    spacing = np.array([(axis[-1] - axis[0]) / (len(axis) - 1) if len(axis) > 1 else vol_resolution for axis in axes])
+    engine = _resolve_engine(engine, coils[0], axes, engine_options=engine_options)
+
+    fields = np.zeros((len(coils) if separate else 1,) + shape + (3,))
+    groups = translation_groups(coils, tolerance)
+    interpolated = []
+
+    for indices, offsets, mismatches in groups:
+        steps = -offsets / spacing
+        snapped = np.abs(steps - np.round(steps)) * spacing <= np.maximum(mismatches[:, None], 1e-6 * spacing)
+        # the position of a rounded copy is not known any better than its vertex mismatch
+        steps = np.where(snapped, np.round(steps), steps)
+        # member field at grid point p is the field of the first coil at p - offset, i.e. steps grid points away
+
+        low = np.floor(steps.min(axis=0)).astype(int)
+        extra = np.ceil(steps.max(axis=0)).astype(int) - low + (~snapped).any(axis=0)
+        extended = tuple(axes[c][0] + (np.arange(shape[c] + extra[c]) + low[c]) * spacing[c] for c in range(3))
+        reference = _axes_volume(np.asarray(coils[indices[0]], dtype=float), extended, 'z', max_bytes, engine, engine_options)
+
+        for number, (index, step) in enumerate(zip(indices, steps - low)):
+            first = np.floor(step + 1e-9).astype(int)
+            fraction = np.where(np.abs(step - first) < 1e-6, 0.0, step - first)
+
+            field = np.zeros(shape + (3,))
+            for corner in np.ndindex(2, 2, 2):
+                weight = np.prod([fraction[c] if corner[c] else 1 - fraction[c] for c in range(3)])
+                if weight == 0: continue
+                window = tuple(slice(first[c] + corner[c], first[c] + corner[c] + shape[c]) for c in range(3))
+                field += weight * reference[window]
+            # trilinear blend of the 8 neighbouring grid shifts, a plain shift for whole steps
+
+            if fraction.any() and check_points:
+                estimate = np.zeros(shape)
+                for c in np.nonzero(fraction)[0]:
+                    inner = (slice(None),) * c + (slice(1, -1),)
+                    estimate[inner] += fraction[c] * (1 - fraction[c]) / 2 * np.linalg.norm(np.diff(field, 2, axis=c), axis=-1)
+                # interpolation error ~ f (1 - f) / 2 h^2 |d2B/dx2| per interpolated axis
+                worst = np.argpartition(estimate.ravel(), -min(check_points, estimate.size))[-check_points:]
+                sample = np.unravel_index(worst, shape)
+                check = 'segment' if engine == 'fft' else engine
+                exact = ENGINES[check](np.asarray(coils[index], dtype=float), *(axes[c][sample[c]] for c in range(3)), max_bytes,
+                                       **(engine_options if check == engine else {}))
+                peak = np.abs(field).max()
+                interpolated.append((index, tuple(offsets[number].tolist()), float(np.abs(field[sample] - exact).max() / peak) if peak else 0.0))
+
+            fields[index if separate else 0] += field
+
+    if stats is not None:
+        stats.update(groups=len(groups), interpolated=interpolated, mismatch=max(float(group[2].max()) for group in groups) if groups else 0.0)
+    return fields if separate else fields[0]
 
 def get_field_vector(targetVolume, position, start_point, volume_resolution):
     '''
     Returns the B vector [Bx, By, Bz] components in a generated Target Volume at a given position tuple (x, y, z) in a coordinate system
+    Uses the grid point below the position. For interpolated, vectorized queries with proper errors use query_util.FieldQuery.
 
     start_point: (x, y, z) = (0, 0, 0) = bottom left corner position of the box
     volume_resolution: Division of volumetric meshgrid (generate a point every volume_resolution cm)
@@ -167,38 +1163,246 @@ def get_field_vector(targetVolume, position, start_point, volume_resolution):
 '''
 - If you are indexing a targetvolume meshgrid on your own, remember to account for the offset (starting point), and spatial resolution
 - You will need an index like <relativePosition = ((np.array(position) - np.array(start_point)) / volume_resolution).astype(int)>
+- query_util.FieldQuery does this (with interpolation) for many positions at once
 '''
 
+VOLUME_MAGIC = b"BSVOL01\n"
+VOLUME_ALIGN = 64
+
+def _volume_header(f):
+    '''
+    Reads the header of a target volume file opened in binary mode.
+
+    Returns (meta, offset): the grid metadata and the byte offset of the field data
+    '''
+    magic = f.read(len(VOLUME_MAGIC))
+    if magic != VOLUME_MAGIC:
+        raise ValueError(f"{getattr(f, 'name', 'file')} is not a target volume file")
+    length = int.from_bytes(f.read(4), "little")
+    meta = json.loads(f.read(length).decode("ascii"))
+    offset = len(VOLUME_MAGIC) + 4 + length
+    return meta, offset + (-offset) % VOLUME_ALIGN
+
+def _volume_order(slab_axis, shape):
+    '''
+    Axis order of the data on disk: the slab axis first, so that one plane along it is a contiguous block.
+    A stack of volumes (see count in create_target_volume) keeps the volume index outermost.
+    '''
+    first = AXES.index(slab_axis)
+    order = (first,) + tuple(c for c in range(3) if c != first) + (3,)
+    return order if len(shape) == 4 else (0,) + tuple(c + 1 for c in order)
+
+def _volume_meta(box_size, start_point, vol_resolution, dtype, slab_axis, count=None):
+    # header of a target volume file, as read back by _volume_header
+    shape = [len(axis) for axis in grid_axes(box_size, start_point, vol_resolution)] + [3]
+    if count is not None: shape = [int(count)] + shape
+    return {"box_size": [float(v) for v in box_size], "start_point": [float(v) for v in start_point],
+            "vol_resolution": float(vol_resolution), "shape": shape, "dtype": np.dtype(dtype).str, "slab_axis": slab_axis}
+
+def create_target_volume(filename, box_size, start_point, vol_resolution, dtype=np.float64, slab_axis='z', count=None):
+    '''
+    Creates an empty target volume file with its grid metadata, see save_target_volume for the arguments.
+    count: If given, the file holds a stack of count volumes on the same grid, e.g. one per coil
+
+    Returns the writable memory map, indexed [x, y, z, component] like produce_target_volume,
+    or [volume, x, y, z, component] for a stack
+    '''
+    meta = _volume_meta(box_size, start_point, vol_resolution, dtype, slab_axis, count)
+    shape = meta["shape"]
+    header = json.dumps(meta).encode("ascii")
+    offset = len(VOLUME_MAGIC) + 4 + len(header)
+
+    with open(filename, "wb") as f:
+        f.write(VOLUME_MAGIC + len(header).to_bytes(4, "little") + header + b" " * ((-offset) % VOLUME_ALIGN))
+        f.truncate(offset + (-offset) % VOLUME_ALIGN + int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        # sparse file of the full size, zero filled
+
+    return open_target_volume(filename, "r+")
+
+def open_target_volume(filename, mode="r"):
+    '''
+    Memory maps a target volume file without reading it.
+
+    mode: "r" read only, "r+" read and write, "c" copy on write (see numpy.memmap)
+
+    Returns the memory map, indexed [x, y, z, component] like produce_target_volume, or [volume, x, y, z, component] for a stack
+    '''
+    with open(filename, "rb") as f: meta, offset = _volume_header(f)
+    order = _volume_order(meta["slab_axis"], meta["shape"])
+    stored = tuple(meta["shape"][c] for c in order)
+
+    volume = np.memmap(filename, dtype=np.dtype(meta["dtype"]), mode=mode, offset=offset, shape=stored)
+    return volume.transpose(np.argsort(order))
+
+def save_target_volume(filename, targetVolume, box_size, start_point, vol_resolution, dtype=None, slab_axis='z'):
+    '''
+    Saves a target volume with its grid metadata, so that it can be read back without knowing the grid.
+
+    targetVolume: (nx, ny, nz, 3) field, as returned by produce_target_volume, or a stack (n, nx, ny, nz, 3) of such fields
+    box_size: (x, y, z) dimensions of the box in cm
+    start_point: (x, y, z) = (0, 0, 0) = bottom left corner position of the box AKA the offset
+    vol_resolution: Division of volumetric meshgrid (generate a point every volume_resolution cm)
+    dtype: Storage type, e.g. np.float32 or np.float16 to halve or quarter the file, by default the type of targetVolume
+    slab_axis: Axis stored outermost, planes along it are contiguous in the file and cheapest to read with read_target_slice
+    '''
+    targetVolume = np.asarray(targetVolume)
+    volume = create_target_volume(filename, box_size, start_point, vol_resolution, targetVolume.dtype if dtype is None else dtype, slab_axis,
+                                  len(targetVolume) if targetVolume.ndim == 5 else None)
+    if volume.shape != targetVolume.shape:
+        raise ValueError(f"target volume of shape {targetVolume.shape} does not match its grid {volume.shape}")
+    volume[...] = targetVolume
+    volume.flush()
+
+DEFAULT_TILE = (64, 64, 16)
+
+def _tile_key(coil, engine, engine_options):
+    # int64 fingerprint of what a tiled run computes, a resumed run must match it
+    digest = hashlib.blake2b(np.ascontiguousarray(coil, dtype=float).tobytes(), digest_size=8)
+    digest.update(repr((engine, sorted(engine_options.items()))).encode())
+    return int.from_bytes(digest.digest(), "little", signed=True)
+
+def _tile_record(filename, record, header, n_tiles, meta):
+    '''
+    Opens the record of finished tiles of an interrupted run that computed the same volume into filename.
+    Returns None if there is no such record.
+    '''
+    if not (os.path.exists(filename) and os.path.exists(record)): return None
+    with open(filename, "rb") as f: stored, _ = _volume_header(f)
+    done = np.lib.format.open_memmap(record, mode="r+")
+    if stored == meta and done.shape == (len(header) + n_tiles,) and np.array_equal(done[:len(header)], header): return done
+    return None
+
+def produce_target_volume_file(coil, filename, box_size, start_point, vol_resolution, tile=DEFAULT_TILE,
+                               max_bytes=DEFAULT_MAX_BYTES, engine='auto', dtype=np.float64, **engine_options):
+    '''
+    Generates a target volume tile by tile straight into a target volume file (see save_target_volume),
+    for volumes that do not fit into memory. The memory use depends on tile and max_bytes, not on the size of the volume.
+
+    The finished tiles are recorded in filename + ".tiles". If the run is interrupted, calling this function again
+    with the same arguments only computes the missing tiles. The record is removed once the volume is complete.
+
+    Coil, box_size, start_point, vol_resolution, max_bytes, engine_options: see produce_target_volume
+    filename: Target volume file to write
+    tile: (x, y, z) number of grid points per tile
+    engine: Name of the field engine in ENGINES, 'auto' picks it per tile like produce_target_volume
+    dtype: Storage type of the file, see save_target_volume
+
+    Returns the finished volume, memory mapped read only
+    '''
+    axes = grid_axes(box_size, start_point, vol_resolution)
+    shape = tuple(len(axis) for axis in axes)
+    tile = tuple(int(min(t, n)) for t, n in zip(tile, shape))
+    tiles = [range(0, n, t) for n, t in zip(shape, tile)]
+    n_tiles = int(np.prod([len(r) for r in tiles]))
+
+    coil = np.ascontiguousarray(coil, dtype=float)
+    engine = _resolve_engine(engine, coil, axes, tile, engine_options)
+    if np.dtype(dtype).itemsize <= 4 and engine in ('midpoint', 'planar', 'segment', 'separable'): engine_options['dtype'] = np.float32
+    # a single (or half) precision file is computed in single precision as well
+    record = filename + ".tiles"
+    header = np.array(tile + (_tile_key(coil, engine, engine_options),), dtype=np.int64)
+    # the record holds the tile size, the fingerprint and one flag per tile
+
+    done = _tile_record(filename, record, header, n_tiles, _volume_meta(box_size, start_point, vol_resolution, dtype, 'z'))
+    if done is None:
+        create_target_volume(filename, box_size, start_point, vol_resolution, dtype)
+        done = np.lib.format.open_memmap(record, mode="w+", dtype=np.int64, shape=(len(header) + n_tiles,))
+        done[:len(header)] = header
+        done.flush()
+
+    volume = open_target_volume(filename, "r+")
+    if engine in _PREPARE: coil, engine_options = _PREPARE[engine](coil, **engine_options)
+
+    for number, (k, j, i) in enumerate((k, j, i) for k in tiles[2] for j in tiles[1] for i in tiles[0]):
+        if done[len(header) + number]: continue
+        window = (slice(i, i + tile[0]), slice(j, j + tile[1]), slice(k, k + tile[2]))
+        # z tiles outermost, like the layout of the file
+
+        Z, Y, X = np.meshgrid(axes[2][window[2]], axes[1][window[1]], axes[0][window[0]], indexing='ij')
+        volume[window] = ENGINES[engine](coil, X,Y,Z, max_bytes, **engine_options)
+        volume.flush()
+        done[len(header) + number] = 1
+        done.flush()
+        # the flag is only set once the tile is on disk
+
+    del done
+    os.remove(record)
+    return open_target_volume(filename)
+
 def write_target_volume(input_filename,output_filename, box_size, start_point, 
-                        coil_resolution=1, volume_resolution=1):
+                        coil_resolution=1, volume_resolution=1, engine='auto', workers=1, dtype=None, tile=None):
     '''
     Takes a coil specified in input_filename, generates a target volume, and saves the generated target volume to output_filename.
 
     box_size: (x, y, z) dimensions of the box in cm
     start_point: (x, y, z) = (0, 0, 0) = bottom left corner position of the box AKA the offset
-    coil_resolution: How long each coil subsegment should be
+    coil_resolution: How long each coil subsegment should be (not used by the 'segment', 'fft', 'gauss' and 'separable' engines)
     volume_resolution: Division of volumetric meshgrid (generate a point every volume_resolution cm)
+    engine: Name of the field engine, see produce_target_volume
+    workers: Number of processes evaluating the target volume, see produce_target_volume
+    dtype: Storage type of the file, see save_target_volume. Files of float32 or float16 are computed in single precision
+        by the 'midpoint', 'planar', 'segment' and 'separable' engines
+    tile: If given, the volume is computed tile by tile straight into the file and an interrupted run resumes,
+        see produce_target_volume_file (workers is not used then)
     '''
     coil = parse_coil(input_filename) 
-    chopped = slice_coil(coil, coil_resolution)
-    targetVolume = produce_target_volume(chopped, box_size, start_point, volume_resolution)
+    engine = _resolve_engine(engine, coil, grid_axes(box_size, start_point, volume_resolution), tile)
+    chopped = slice_coil(coil, coil_resolution) if engine in ('midpoint', 'planar', 'tree', 'multipole') else coil
+    options = {'dtype': np.float32} if dtype is not None and np.dtype(dtype).itemsize <= 4 and engine in ('midpoint', 'planar', 'segment', 'separable') else {}
+    # a single (or half) precision file is computed in single precision as well
+
+    if tile is not None:
+        produce_target_volume_file(chopped, output_filename, box_size, start_point, volume_resolution, tile,
+                                   engine=engine, dtype=np.float64 if dtype is None else dtype)
+        return
+
+    targetVolume = produce_target_volume(chopped, box_size, start_point, volume_resolution, engine=engine, workers=workers, **options)
 
-    with open(output_filename, "wb") as f: np.save(f, targetVolume)
-    # stored in standard numpy pickle form
+    save_target_volume(output_filename, targetVolume, box_size, start_point, volume_resolution, dtype)
+    # stored with its grid, see save_target_volume
 
-def read_target_volume(filename):
+def read_target_volume(filename, mmap_mode=None):
     '''
     Takes the name of a saved target volume and loads the B vector meshgrid.
-    Returns None if not found.
+
+    mmap_mode: None reads the whole volume into memory, "r", "r+" or "c" memory map it instead (see open_target_volume)
+    Volumes saved by older versions as plain numpy arrays are read as well.
+    Raises FileNotFoundError if the file does not exist, ValueError if it is not a target volume.
     '''
-    targetVolume = None
+    with open(filename, "rb") as f: magic = f.read(len(VOLUME_MAGIC))
+    if magic != VOLUME_MAGIC: return np.load(filename, mmap_mode=mmap_mode)
+    # plain np.save file of earlier versions
 
-    try:
-        with open(filename, "rb") as f:
-            targetVolume = np.load(f)
-        return targetVolume
-    except:
-        pass
+    volume = open_target_volume(filename, mmap_mode or "r")
+    return volume if mmap_mode else np.array(volume)
+
+def read_volume_grid(filename):
+    '''
+    Returns the grid of a saved target volume as a dict with box_size, start_point and vol_resolution,
+    ready to be passed on as keyword arguments, e.g. plot_fields(volume, **read_volume_grid(filename)).
+    '''
+    with open(filename, "rb") as f: meta, _ = _volume_header(f)
+    return {"box_size": tuple(meta["box_size"]), "start_point": tuple(meta["start_point"]), "vol_resolution": meta["vol_resolution"]}
+
+def read_target_slice(filename, which_plane='z', level=0):
+    '''
+    Reads the plane of a saved target volume at the first grid level >= level, without reading the rest of the volume.
+    Planes along the slab axis of the file (z by default) are a single contiguous read.
+
+    which_plane: Plane to read, can be "x", "y" or "z"
+    level : The "height" of the plane. For instance the Z = 5 plane would have a level of 5
+
+    Returns the field in the plane, indexed [first remaining axis, second remaining axis, component], e.g. [x, y, component] for "z",
+    with the volume index in front for a stack of volumes
+    '''
+    grid = read_volume_grid(filename)
+    c = AXES.index(which_plane)
+    axis = grid_axes(grid["box_size"], grid["start_point"], grid["vol_resolution"])[c]
+    index = np.nonzero(axis >= level)[0]
+    if not len(index): raise ValueError(f"level {level} is outside the volume along {which_plane}")
+
+    volume = open_target_volume(filename)
+    return np.array(volume[(slice(None),) * (volume.ndim - 4 + c) + (index[0],)])
 
 ## plotting routines
 
@@ -0,0 +1,85 @@
+'''
+On-disk cache of target volumes for the Biot-Savart calculator in biot_savart_v4_3.py
+
+Target volumes are stored under a key that hashes the coil (vertices and currents) and the grid and engine
+they were computed with, so a coil file that was rewritten with the same content is still a hit.
+The least recently used volumes are removed once the cache grows beyond its size limit.
+
+All lengths are in cm, B-field is in G
+'''
+import os
+import json
+import hashlib
+import numpy as np
+import biot_savart_v4_3 as bs
+
+CACHE_DIR = os.environ.get("BIOT_SAVART_CACHE", ".field_cache")
+CACHE_BYTES = 2 * 2**30
+VERSION = 1
+# bump when the stored fields change, so that old entries are no longer hit
+
+def field_key(coil, box_size, start_point, coil_resolution, volume_resolution, engine, dtype=None):
+    '''
+    Returns the hex digest that identifies a target volume of coil on the given grid.
+    '''
+    digest = hashlib.sha256(np.ascontiguousarray(coil, dtype=float).tobytes())
+    digest.update(json.dumps([VERSION, [float(v) for v in box_size], [float(v) for v in start_point], float(coil_resolution),
+                              float(volume_resolution), engine, None if dtype is None else np.dtype(dtype).str]).encode())
+    return digest.hexdigest()
+
+def cache_size(cache_dir=CACHE_DIR):
+    '''
+    Returns the total size in bytes of the cached volumes.
+    '''
+    return sum(entry.stat().st_size for entry in os.scandir(cache_dir) if entry.is_file()) if os.path.isdir(cache_dir) else 0
+
+def evict(cache_dir=CACHE_DIR, max_size=CACHE_BYTES, keep=()):
+    '''
+    Removes the least recently used volumes until the cache holds at most max_size bytes.
+    Files in keep are never removed.
+
+    Returns the number of removed volumes
+    '''
+    if not os.path.isdir(cache_dir): return 0
+    entries = sorted((entry for entry in os.scandir(cache_dir) if entry.is_file()), key=lambda entry: entry.stat().st_mtime)
+    size = sum(entry.stat().st_size for entry in entries)
+
+    removed = 0
+    for entry in entries:
+        if size <= max_size: break
+        if entry.path in keep: continue
+        size -= entry.stat().st_size
+        os.remove(entry.path)
+        removed += 1
+    return removed
+
+def cached_target_volume(input_filename, box_size, start_point, coil_resolution=1, volume_resolution=1, engine='auto',
+                         workers=1, dtype=None, cache_dir=CACHE_DIR, max_size=CACHE_BYTES):
+    '''
+    Returns the name of a target volume file of the coil in input_filename, computed with write_target_volume
+    on a miss and taken from the cache on a hit. Read it with bs.read_target_volume and bs.read_volume_grid.
+
+    box_size, start_point, coil_resolution, volume_resolution, engine, workers, dtype: see bs.write_target_volume
+    cache_dir: Directory of the cache, created if missing
+    max_size: Size limit of the cache in bytes, least recently used volumes are removed beyond it
+    '''
+    coil = bs.parse_coil(input_filename)
+    engine = bs._resolve_engine(engine, coil, bs.grid_axes(box_size, start_point, volume_resolution))
+    filename = os.path.join(cache_dir, field_key(coil, box_size, start_point, coil_resolution, volume_resolution, engine, dtype) + ".vol")
+
+    if os.path.exists(filename):
+        os.utime(filename)
+        return filename
+    # hit, the modification time orders the entries for eviction
+
+    os.makedirs(cache_dir, exist_ok=True)
+    partial = f"{filename}.{os.getpid()}.partial"
+    try:
+        bs.write_target_volume(input_filename, partial, box_size, start_point, coil_resolution, volume_resolution, engine, workers, dtype)
+        os.replace(partial, filename)
+    finally:
+        if os.path.exists(partial): os.remove(partial)
+    # written under a temporary name, so an interrupted run never leaves a broken entry
+
+    evict(cache_dir, max_size, keep=(filename,))
+    return filename
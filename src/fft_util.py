@@ -0,0 +1,164 @@
+'''
+FFT convolution field engine for planar coils on regular grids, for the Biot-Savart calculator in biot_savart_v4_3.py
+
+The current of every coil layer (all segments at one z) is rasterized onto the x-y lattice of the target grid
+and convolved with the Biot-Savart kernel for the exact z-offset of every target plane.
+This costs O(N log N) per plane instead of O(segments x N).
+
+Accuracy limits: the current is deposited onto the lattice points with bilinear weights, so the result
+matches the direct sum to ~1% at distances of more than ~3 grid spacings from the copper, and improves
+with (spacing / distance)^2 further away. In the plane of the coil and within a few grid spacings of a
+track the rasterization error is of the order of the field itself; use the 'segment' engine there.
+
+All lengths are in cm, B-field is in G
+'''
+import numpy as np
+import scipy.fft
+import biot_savart_v4_3 as bs
+
+def planar_layers(coil, tol=1e-9):
+    '''
+    Groups the segments of a coil by the z value of the plane they lie in.
+
+    Returns a list of (z, starts (S, 2), ends (S, 2), currents (S,)).
+    Raises a ValueError if a segment is not parallel to the x-y plane.
+    '''
+    coil = np.asarray(coil, dtype=float)
+    starts, ends, currents = bs._straight_segments(coil)
+    if (np.abs(ends[:, 2] - starts[:, 2]) > tol).any():
+        raise ValueError("the fft engine needs a planar coil (all segments parallel to the x-y plane)")
+
+    layers = []
+    z = starts[:, 2]
+    for level in np.unique(np.round(z / tol) * tol):
+        mask = np.abs(z - level) <= tol
+        layers.append((float(z[mask].mean()), starts[mask, :2], ends[mask, :2], currents[mask]))
+    return layers
+
+def is_planar(coil, tol=1e-9):
+    '''
+    Returns True if all segments of the coil are parallel to the x-y plane.
+    '''
+    coil = np.asarray(coil, dtype=float)
+    return coil.shape[1] > 1 and bool((np.abs(np.diff(coil[2])) <= tol).all())
+
+def rasterize(starts, ends, currents, origin, spacing):
+    '''
+    Deposits the current moments I * dl of planar segments onto the lattice origin + (i, j) * spacing.
+
+    Every segment is cut into pieces no longer than half a spacing, whose moments are spread onto the
+    four surrounding lattice points with bilinear weights.
+
+    Returns (offset, Jx, Jy): the lattice index of Jx[0, 0] and the deposited x and y moments
+    '''
+    origin, spacing = np.asarray(origin, dtype=float), np.asarray(spacing, dtype=float)
+    L = ends - starts
+    pieces = np.maximum(1, np.ceil(np.abs(L / spacing).max(axis=1) * 2)).astype(int)
+
+    segment = np.repeat(np.arange(len(starts)), pieces)
+    first = np.repeat(np.cumsum(pieces) - pieces, pieces)
+    t = (np.arange(pieces.sum()) - first + 0.5) / pieces[segment]
+    # midpoints of the pieces as fraction along their segment
+
+    position = (starts[segment] + t[:, None] * L[segment] - origin) / spacing
+    moment = L[segment] * (currents[segment] / pieces[segment])[:, None]
+
+    cell = np.floor(position).astype(int)
+    frac = position - cell
+    offset = cell.min(axis=0)
+    shape = tuple(cell.max(axis=0) - offset + 2)
+
+    J = np.zeros((2,) + shape)
+    for dx in (0, 1):
+        for dy in (0, 1):
+            w = (frac[:, 0] if dx else 1 - frac[:, 0]) * (frac[:, 1] if dy else 1 - frac[:, 1])
+            flat = np.ravel_multi_index((cell[:, 0] - offset[0] + dx, cell[:, 1] - offset[1] + dy), shape)
+            for c in range(2):
+                J[c] += np.bincount(flat, weights=w * moment[:, c], minlength=J[c].size).reshape(shape)
+    return offset, J[0], J[1]
+
+def regular_axes(points, rtol=1e-9):
+    '''
+    Recovers the axes of a regular grid from its (N, 3) points.
+
+    Returns (x, y, z, index) with index (N, 3) the grid indices of every point,
+    or raises a ValueError if the points do not form a full grid with uniform x and y spacing.
+    '''
+    axes, index = [], []
+    for c in range(3):
+        values, inverse = np.unique(points[:, c], return_inverse=True)
+        axes.append(values)
+        index.append(inverse.ravel())
+    if np.prod([len(a) for a in axes]) != len(points):
+        raise ValueError("the fft engine needs the points of a full regular grid")
+    for a in axes[:2]:
+        if len(a) > 2 and not np.allclose(np.diff(a), a[1] - a[0], rtol=1e-6, atol=rtol):
+            raise ValueError("the fft engine needs uniformly spaced x and y coordinates")
+    return axes[0], axes[1], axes[2], np.column_stack(index)
+
+def fft_grid_field(coil, x, y, z):
+    '''
+    Calculates the field of a planar coil on the regular grid spanned by the axes x, y (uniform) and z (any).
+
+    Returns an (nx, ny, nz, 3) array in G, indexed [x, y, z, component]
+    '''
+    hx = x[1] - x[0] if len(x) > 1 else 1.0
+    hy = y[1] - y[0] if len(y) > 1 else hx
+    if len(x) == 1: hx = hy
+    spacing = np.array([hx, hy])
+
+    B = np.zeros((len(x), len(y), len(z), 3))
+    for level, starts, ends, currents in planar_layers(coil):
+        offset, Jx, Jy = rasterize(starts, ends, currents, (x[0], y[0]), spacing)
+        ns = Jx.shape
+        n_targets = (len(x), len(y))
+
+        d_min = [-(offset[c] + ns[c] - 1) for c in range(2)]
+        d_max = [n_targets[c] - 1 - offset[c] for c in range(2)]
+        nk = [d_max[c] - d_min[c] + 1 for c in range(2)]
+        fft_shape = [scipy.fft.next_fast_len(ns[c] + nk[c] - 1, real=True) for c in range(2)]
+        # lattice offsets (target - source) and the padded size of the linear convolution
+
+        FJx = scipy.fft.rfft2(Jx, fft_shape)
+        FJy = scipy.fft.rfft2(Jy, fft_shape)
+
+        KX, KY = np.meshgrid(np.arange(d_min[0], d_max[0] + 1) * hx, np.arange(d_min[1], d_max[1] + 1) * hy, indexing='ij')
+        window = (slice(ns[0] - 1, ns[0] - 1 + n_targets[0]), slice(ns[1] - 1, ns[1] - 1 + n_targets[1]))
+
+        for k, zk in enumerate(z):
+            dz = zk - level
+            r2 = KX**2 + KY**2 + dz**2
+            zero = r2 == 0
+            r2[zero] = 1
+            inv3 = 1 / (r2 * np.sqrt(r2))
+            inv3[zero] = 0
+            # kernel r / |r|^3 on the lattice offsets, no contribution at r = 0 (like the direct sum)
+
+            FKx = scipy.fft.rfft2(KX * inv3, fft_shape)
+            FKy = scipy.fft.rfft2(KY * inv3, fft_shape)
+            FKz = scipy.fft.rfft2(dz * inv3, fft_shape)
+
+            B[:, :, k, 0] += scipy.fft.irfft2(FJy * FKz, fft_shape)[window]
+            B[:, :, k, 1] -= scipy.fft.irfft2(FJx * FKz, fft_shape)[window]
+            B[:, :, k, 2] += scipy.fft.irfft2(FJx * FKy - FJy * FKx, fft_shape)[window]
+            # J x r with J = (Jx, Jy, 0)
+
+    return B * bs.FACTOR
+
+def calculate_fft_field(coil, x, y, z, max_bytes=bs.DEFAULT_MAX_BYTES):
+    '''
+    Calculates magnetic field vector as a result of some position and current x, y, z, I
+    by FFT convolution of the rasterized coil current with the Biot-Savart kernel.
+
+    Coil: Input Coil Positions in format specified above, all segments parallel to the x-y plane (sliced or not)
+    x, y, z: positions in cm that form a full regular grid (uniform spacing along x and y)
+    max_bytes: Unused, the memory use is set by the FFT sizes
+
+    Output B-field is a 3-D vector in units of G, in the same layout as calculate_field
+    '''
+    points, shape = bs._as_points(x, y, z)
+    xs, ys, zs, index = regular_axes(points)
+
+    B = fft_grid_field(coil, xs, ys, zs)
+
+    return B[index[:, 0], index[:, 1], index[:, 2]].reshape(shape)
@@ -7,6 +7,7 @@ import matplotlib.pyplot as plt
 from matplotlib import cm
 from scipy.interpolate import griddata
 import biot_savart_v4_3 as bs
+import cache_util
 
 
 def plot_3d_fields(Bfields, box_size, start_point, vol_resolution, stride=2):
@@ -130,16 +131,17 @@ def plot_3d_fields3(Bfields, box_size, start_point, vol_resolution, stride=1, le
 def magnetic_field(module_name, left_upper_corner, diameter, plane, level):
 	x,y = left_upper_corner
 	box = diameter
-	bs.write_target_volume(f"{module_name}.txt", f"{module_name}_targetvol", (box, box, 5), (x, y, -2.5), 1, 1)
-	# generates a target volume from the coil stored at coil.txt
+	volume_file = cache_util.cached_target_volume(f"{module_name}.txt", (box, box, 5), (x, y, -2.5), 1, 1)
+	# generates a target volume from the coil stored at coil.txt, or reuses the cached one of an earlier run
 	# uses 1 cm resolution
 
 	bs.plot_coil(f"{module_name}.txt")
 	# plots the coil stored at coil.txt
 
-	volume = bs.read_target_volume(f"{module_name}_targetvol")
-	# reads the volume we created
+	volume = bs.read_target_volume(volume_file, mmap_mode="r")
+	grid = bs.read_volume_grid(volume_file)
+	# reads the volume we created and the grid stored with it
     
-	bs.plot_fields(volume, (box, box, 5), (x, y, -2.5), 1, which_plane=plane, level=level, num_contours=50)
-	plot_3d_fields(volume, (box, box, 5), (x, y, -2.5), vol_resolution=1, stride=1) # quiver plot of (Bx, By, Bz) in 3 dimensions
-	plot_3d_fields3(volume, (box, box, 5), (x, y, -2.5), vol_resolution=1, stride=1, level=level) # Bz at z=0
\ No newline at end of file
+	bs.plot_fields(volume, **grid, which_plane=plane, level=level, num_contours=50)
+	plot_3d_fields(volume, **grid, stride=1) # quiver plot of (Bx, By, Bz) in 3 dimensions
+	plot_3d_fields3(volume, **grid, stride=1, level=level) # Bz at z=0
\ No newline at end of file
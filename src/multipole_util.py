@@ -0,0 +1,93 @@
+'''
+Far-field multipole engine for the Biot-Savart calculator in biot_savart_v4_3.py
+
+The field of the whole coil is expanded about the centre of its bounding box, up to second order
+(net current element, dipole and quadrupole terms, see tree_util._expansion_coefficients). Far from the coil
+the expansion replaces the sum over all coil elements by a fixed 23 terms per point, e.g. for large
+enclosure volumes of which the coil fills only a small part.
+
+The neglected third order term is bounded by REMAINDER_SAFETY * S3 / r^5 (S3 = sum |m| |delta|^3 over the elements).
+A point takes the expansion when that bound is below tolerance times the field there, and the direct
+midpoint sum otherwise, so the switch distance follows from the tolerance point by point: near the coil,
+and where the far field of an open coil (lead-outs) nearly cancels, the direct sum is used.
+
+All lengths are in cm, B-field is in G
+'''
+import numpy as np
+import biot_savart_v4_3 as bs
+import tree_util
+
+REMAINDER_SAFETY = 2.0
+# measured: |error| r^5 / S3 < 0.9 from 1.2 coil radii outwards for the square, octagonal and helical coils of main.main
+MIN_DISTANCE = 2.0
+# the expansion is never used closer than MIN_DISTANCE coil radii to the centre
+
+class CoilExpansion:
+    '''
+    Second order multipole expansion of the field of a whole coil about the centre of its bounding box.
+
+    coil: Input Coil Positions, already sub-divided into small pieces using slice_coil
+
+    centre, radius: expansion centre and distance of the farthest coil element from it
+    coefficients: (3, 23) coefficients of the basis of tree_util._expansion_basis
+    remainder: S3 = sum |m| |delta|^3, scale of the neglected third order term
+    elements: (centres, dl, weights) of the midpoint rule, for the points near the coil
+    '''
+    def __init__(self, coil):
+        self.elements = bs._richardson_elements(np.asarray(coil, dtype=float))
+        centres, dl, weights = self.elements
+        moments = dl * weights[:, None]
+
+        self.centre = (centres.min(axis=0) + centres.max(axis=0)) / 2 if len(centres) else np.zeros(3)
+        delta = centres - self.centre
+        distance = np.linalg.norm(delta, axis=1)
+        self.radius = float(distance.max()) if len(centres) else 0.0
+        self.remainder = float((np.linalg.norm(moments, axis=1) * distance**3).sum())
+
+        M0 = moments.sum(axis=0)
+        D = np.einsum('ka,kb->ab', moments, delta)
+        E = np.einsum('ka,kb->ab', np.cross(moments, delta), delta)
+        F = np.einsum('ka,kb,kc->abc', moments, delta, delta)
+        self.coefficients = tree_util._expansion_coefficients(M0[None], D[None], E[None], F[None])[0]
+
+def calculate_multipole_field(coil, x, y, z, max_bytes=bs.DEFAULT_MAX_BYTES, tolerance=1e-3, stats=None):
+    '''
+    Calculates magnetic field vector as a result of some position and current x, y, z, I
+    from the multipole expansion of the coil far from it, and the direct midpoint sum near it.
+
+    Coil: Input Coil Positions, already sub-divided into small pieces using slice_coil, or a CoilExpansion of it
+    x, y, z: position in cm
+    max_bytes: Upper bound for the scratch memory of the direct sum, see calculate_field
+    tolerance: Relative accuracy of the field at every point that takes the expansion, compared to calculate_field
+    stats: Optional dict, receives 'far' and 'near' (number of points that took the expansion and the direct sum),
+        'switch_distance' (distance from the expansion centre of the nearest far point, inf if there is none)
+        and 'radius' (of the coil about the expansion centre)
+
+    Output B-field is a 3-D vector in units of G, in the same layout as calculate_field
+    '''
+    expansion = coil if isinstance(coil, CoilExpansion) else CoilExpansion(coil)
+    points, shape = bs._as_points(x, y, z)
+    B = np.zeros((len(points), 3))
+
+    d = points - expansion.centre
+    r = np.sqrt(np.einsum('ij,ij->i', d, d))
+    far = np.flatnonzero(r > MIN_DISTANCE * expansion.radius) if expansion.radius > 0 else np.zeros(0, dtype=int)
+    # a coil without extent (no elements) has no field, every point takes the direct sum of nothing
+
+    batch = max(1, int(max_bytes) // (8 * 30))
+    for b0 in range(0, len(far), batch):
+        index = far[b0:b0+batch]
+        B[index] = tree_util._expansion_basis(d[index]) @ expansion.coefficients.T
+    bound = REMAINDER_SAFETY * expansion.remainder / np.maximum(r[far], 1e-300)**5
+    far = far[bound <= tolerance * np.linalg.norm(B[far], axis=1)]
+    # points whose field is too weak for the remainder bound fall back to the direct sum
+
+    near = np.ones(len(points), dtype=bool)
+    near[far] = False
+    B[near] = bs._sum_elements(*expansion.elements, points[near], max_bytes)
+
+    if stats is not None:
+        stats.update(far=len(far), near=int(near.sum()), switch_distance=float(r[far].min()) if len(far) else np.inf,
+                     radius=expansion.radius)
+
+    return (B * bs.FACTOR).reshape(shape)
@@ -0,0 +1,81 @@
+'''
+Point clouds for evaluating the Biot-Savart calculator in biot_savart_v4_3.py off a full box
+
+Builders for lines (e.g. the coil axis), planes, circles and grids return (..., 3) arrays of positions,
+and masks select the points of a region, e.g. those above the footprint of the coil only.
+Pass the positions, or positions[mask], to bs.calculate_point_field; the field has the shape of the positions.
+
+All lengths are in cm, B-field is in G
+'''
+import numpy as np
+import scipy.spatial
+import biot_savart_v4_3 as bs
+
+def line_points(start, end, n):
+    '''
+    Returns n positions (n, 3) evenly spaced from start to end, both included.
+    '''
+    return np.linspace(np.asarray(start, dtype=float), np.asarray(end, dtype=float), n)
+
+def axis_points(coil, z_start, z_end, n):
+    '''
+    Returns n positions (n, 3) from z_start to z_end on the line parallel to z through the centre
+    of the bounding box of the coil, i.e. the axis of the coils of main.main.
+    '''
+    coil = np.asarray(coil, dtype=float)
+    x, y = (coil[:2].min(axis=1) + coil[:2].max(axis=1)) / 2
+    return line_points((x, y, z_start), (x, y, z_end), n)
+
+def plane_points(origin, u, v, nu, nv):
+    '''
+    Returns the (nu, nv, 3) positions of the parallelogram origin + s u + t v, with s and t
+    evenly spaced over [0, 1] (nu and nv values, both ends included).
+
+    e.g. plane_points((0, 0, 1), (10, 0, 0), (0, 10, 0), 101, 101) is a 10 x 10 cm plane 1 cm above the x-y plane
+    '''
+    s, t = np.linspace(0, 1, nu), np.linspace(0, 1, nv)
+    origin, u, v = (np.asarray(vector, dtype=float) for vector in (origin, u, v))
+    return origin + s[:, None, None] * u + t[None, :, None] * v
+
+def circle_points(centre, radius, n, normal=(0, 0, 1)):
+    '''
+    Returns n positions (n, 3) evenly spaced on the circle of radius around centre, in the plane normal to normal.
+    '''
+    normal = np.asarray(normal, dtype=float)
+    normal = normal / np.linalg.norm(normal)
+    helper = np.eye(3)[np.argmin(np.abs(normal))]
+    u = np.cross(normal, helper)
+    u /= np.linalg.norm(u)
+    v = np.cross(normal, u)
+    phi = np.linspace(0, 2 * np.pi, n, endpoint=False)
+    return np.asarray(centre, dtype=float) + radius * (np.cos(phi)[:, None] * u + np.sin(phi)[:, None] * v)
+
+def grid_points(box_size, start_point, vol_resolution):
+    '''
+    Returns the (nx, ny, nz, 3) positions of the target volume grid of produce_target_volume,
+    e.g. to be masked before evaluating.
+    '''
+    X, Y, Z = np.meshgrid(*bs.grid_axes(box_size, start_point, vol_resolution), indexing='ij')
+    return np.stack([X, Y, Z], axis=-1)
+
+def footprint_mask(coil, points, margin=0.0):
+    '''
+    Returns the mask (...) of the positions (..., 3) that lie above or below the footprint of the coil:
+    inside the convex hull of its vertices in the x-y plane, widened by margin (in cm).
+
+    e.g. points = grid_points(box_size, start_point, 0.1); B = bs.calculate_point_field(coil, points[footprint_mask(coil, points)])
+    '''
+    coil = np.asarray(coil, dtype=float)
+    points = np.asarray(points, dtype=float)
+    hull = scipy.spatial.ConvexHull(coil[:2].T)
+    # hull.equations: one (normal, offset) per edge, normal . p + offset <= 0 inside
+    distance = points[..., :2] @ hull.equations[:, :2].T + hull.equations[:, 2]
+    return (distance <= margin).all(axis=-1)
+
+def box_mask(points, box_size, start_point):
+    '''
+    Returns the mask (...) of the positions (..., 3) inside the box of box_size starting at start_point.
+    '''
+    points = np.asarray(points, dtype=float)
+    start_point = np.asarray(start_point, dtype=float)
+    return ((points >= start_point) & (points <= start_point + np.asarray(box_size, dtype=float))).all(axis=-1)
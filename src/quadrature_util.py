@@ -0,0 +1,161 @@
+'''
+Adaptive Gauss-Legendre field engine for the Biot-Savart calculator in biot_savart_v4_3.py
+
+For a straight segment with midpoint c, half length vector H and current I, and a point at d = r - c,
+    B = I (H x d) S,    S = integral over t in [-1, 1] of dt / |d - t H|^3
+so only the scalar S has to be integrated per (segment, point) pair. Its integrand is analytic except at the
+complex t where |d - t H| = 0, and the n-point Gauss-Legendre rule converges like rho^(-2n), rho the
+Bernstein ellipse through that singularity. rho follows from the distance-to-length ratio of the pair, so
+every pair gets the fewest Gauss points that reach the tolerance: a single point (the midpoint rule) for far
+segments, more for near ones. Pairs that would need more than the largest order are split into halves.
+
+The coil does not need to be sliced with slice_coil. The difference to the next lower order, scaled by the known
+rate of convergence (a Richardson extrapolation, like the two midpoint rules of calculate_field), estimates the error,
+see the stats of calculate_gauss_field.
+
+All lengths are in cm, B-field is in G
+'''
+import numpy as np
+import biot_savart_v4_3 as bs
+
+ORDERS = (1, 2, 3, 4, 6, 8, 12, 16, 24, 32)
+# Gauss-Legendre orders a pair can get; pairs that need more are split
+RULES = {n: np.polynomial.legendre.leggauss(n) for n in ORDERS}
+ERROR_SCALE = 4.0
+# error of the n-point rule taken as ERROR_SCALE * rho^(-2n) relative to S; keeps the error of the field within
+# a few times the tolerance on the square and octagonal coils of main.main
+MAX_SPLITS = 30
+# halvings of a segment before the largest order is used regardless, reached only right at the copper
+
+def _thresholds(tolerance):
+    '''
+    Returns the (decreasing) semi-major axes a of the Bernstein ellipse beyond which the orders of ORDERS reach the tolerance.
+
+    The ellipse has its foci at the ends of the segment and passes through the point, so that (in units of |H|)
+    a = (|R1| + |R2|) / |L|, R1 and R2 the offsets from the ends and L = 2 H, and rho = a + sqrt(a^2 - 1).
+    '''
+    rho = (ERROR_SCALE / tolerance)**(1 / (2 * np.array(ORDERS, dtype=float)))
+    return (rho + 1 / rho) / 2
+
+def _semi_axis(dd, dh, hh):
+    '''
+    Returns a (see _thresholds) from |d|^2, d.H and |H|^2 of the pairs.
+    '''
+    return (np.sqrt(np.maximum(dd + 2 * dh + hh, 0)) + np.sqrt(np.maximum(dd - 2 * dh + hh, 0))) / (2 * np.sqrt(hh))
+
+def _gauss(d, H, n, max_bytes):
+    '''
+    Returns the n-point Gauss-Legendre approximation of S for the pairs d, H (m, 3).
+    '''
+    t, w = RULES[n]
+    S = np.empty(len(d))
+    batch = max(1, int(max_bytes) // (8 * 4 * n))
+    for b0 in range(0, len(d), batch):
+        db, Hb = d[b0:b0+batch], H[b0:b0+batch]
+        r = db[:, None, :] - t[None, :, None] * Hb[:, None, :]
+        r2 = np.einsum('ijk,ijk->ij', r, r)
+        S[b0:b0+batch] = (w / (r2 * np.sqrt(r2))) @ np.ones(n)
+    return S
+
+def _integrals(d, H, thresholds, max_bytes, counts, estimate, splits=0):
+    '''
+    Returns S for the pairs d, H (m, 3), and the estimate of its error if estimate is set (else None).
+    thresholds: see _thresholds
+    counts: dict receiving the number of kernel evaluations ('evaluations') and of split pairs ('split')
+    '''
+    a = _semi_axis(np.einsum('ij,ij->i', d, d), np.einsum('ij,ij->i', d, H), np.einsum('ij,ij->i', H, H))
+    level = np.searchsorted(-thresholds, -a)
+    # the lowest order whose threshold a exceeds, len(ORDERS) if none does
+    level[a <= 1 + 1e-12] = -1
+    if splits >= MAX_SPLITS: level = np.minimum(level, len(ORDERS) - 1)
+
+    S = np.zeros(len(d))
+    error = np.zeros(len(d)) if estimate else None
+    for i, n in enumerate(ORDERS):
+        pairs = np.flatnonzero(level == i)
+        if len(pairs) == 0: continue
+        S[pairs] = _gauss(d[pairs], H[pairs], n, max_bytes)
+        counts['evaluations'] += n * len(pairs)
+        if estimate and i:
+            lower = ORDERS[i - 1]
+            rho = a[pairs] + np.sqrt(a[pairs]**2 - 1)
+            ratio = rho**(-2.0 * (n - lower))
+            error[pairs] = np.abs(S[pairs] - _gauss(d[pairs], H[pairs], lower, max_bytes)) * ratio / (1 - ratio)
+            # Richardson: with errors ~ rho^(-2n) the difference to the lower order is the lower order's error
+            # times (1 - ratio), and the error of order n is the lower order's error times ratio
+
+    split = np.flatnonzero(level == len(ORDERS))
+    if len(split):
+        counts['split'] += len(split)
+        halves = [_integrals(d[split] + sign * H[split] / 2, H[split] / 2, thresholds, max_bytes, counts, estimate, splits + 1)
+                  for sign in (1, -1)]
+        S[split] = (halves[0][0] + halves[1][0]) / 2
+        if estimate: error[split] = (halves[0][1] + halves[1][1]) / 2
+        # the halves have H / 2 and midpoints c -+ H / 2: (H / 2) x (d +- H / 2) = (H x d) / 2
+    # the pairs on a segment get no contribution from it, as in calculate_segment_field
+
+    return S, error
+
+def calculate_gauss_field(coil, x, y, z, max_bytes=bs.DEFAULT_MAX_BYTES, tolerance=1e-6, stats=None):
+    '''
+    Calculates magnetic field vector as a result of some position and current x, y, z, I
+    by Gauss-Legendre quadrature along every straight segment, with the order chosen per (segment, point) pair.
+
+    Coil: Input Coil Positions in format specified above (no need to slice it)
+    x, y, z: position in cm
+    max_bytes: Upper bound for the scratch memory used per block of (segments x positions)
+    tolerance: Relative accuracy of the integral of every (segment, point) pair
+    stats: Optional dict, receives 'evaluations' (kernel evaluations, compare with the number of
+        midpoint elements times points of calculate_field), 'pairs', 'split' (pairs split into halves) and
+        'error' (estimated max error of the field at any point, in G, summed over the segments without cancellation,
+        from the difference to the next lower orders; this costs another evaluation at the lower orders)
+
+    Output B-field is a 3-D vector in units of G, in the same layout as calculate_field
+    '''
+    points, shape = bs._as_points(x, y, z)
+    starts, ends, currents = bs._straight_segments(np.asarray(coil, dtype=float))
+    n_sources, n_points = len(starts), len(points)
+    B = np.zeros((n_points, 3))
+    error = np.zeros(n_points) if stats is not None else None
+    counts = {'evaluations': 0, 'split': 0}
+
+    if n_sources and n_points:
+        origin = starts.mean(axis=0)
+        centres, H, points = (starts + ends) / 2 - origin, (ends - starts) / 2, points - origin
+        keep = np.einsum('ij,ij->i', H, H) > 0
+        centres, H, currents = centres[keep], H[keep], currents[keep]
+        V = np.hstack((H, -np.cross(H, centres))) * currents[:, None] # (S, 6): I H and -I H x c
+        n_sources = len(centres)
+        # work relative to the coil, zero length segments carry no field
+
+        thresholds = _thresholds(tolerance)
+        HH = np.einsum('ij,ij->i', H, H)
+        source_block, point_block = bs._block_sizes(n_sources, n_points, 8 * 8, max_bytes)
+        for p0 in range(0, n_points, point_block):
+            P = points[p0:p0+point_block]
+            for s0 in range(0, n_sources, source_block):
+                s1 = min(s0 + source_block, n_sources)
+                d = P[None, :, :] - centres[s0:s1, None, :]
+                dd = np.einsum('spk,spk->sp', d, d)
+                far = _semi_axis(dd, np.einsum('spk,sk->sp', d, H[s0:s1]), HH[s0:s1, None]) >= thresholds[0]
+                S = np.zeros(dd.shape)
+                np.divide(2, dd * np.sqrt(dd), out=S, where=far)
+                counts['evaluations'] += int(far.sum())
+                # the one-point (midpoint) rule of the far pairs, usually nearly all of them, on the whole block
+
+                near = np.flatnonzero(~far)
+                segment = s0 + near // len(P)
+                S.flat[near], E = _integrals(d.reshape(-1, 3)[near], H[segment], thresholds, max_bytes, counts, stats is not None)
+
+                M = V[s0:s1].T @ S # (6, P): I H and -I H x c weighted by S
+                B[p0:p0+len(P)] += np.cross(M[:3].T, P) + M[3:].T
+                if E is not None:
+                    weight = np.abs(currents[segment]) * np.linalg.norm(np.cross(H[segment], d.reshape(-1, 3)[near]), axis=1)
+                    error[p0:p0+len(P)] += np.bincount(near % len(P), weight * E, minlength=len(P))
+                    # |I (H x d)| times the error of S, summed over the segments: a bound without cancellation
+
+    if stats is not None:
+        stats.update(evaluations=counts['evaluations'], pairs=n_sources * n_points, split=counts['split'],
+                     error=float(error.max() * bs.FACTOR) if n_points else 0.0)
+
+    return (B * bs.FACTOR).reshape(shape)
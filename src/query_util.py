@@ -0,0 +1,90 @@
+'''
+Interpolating field queries on target volumes of the Biot-Savart calculator in biot_savart_v4_3.py
+
+A FieldQuery is built once from a target volume and its grid, and answers batches of point queries
+by trilinear or tricubic (cubic B-spline) interpolation. The interpolation coefficients (for tricubic
+the prefiltered spline coefficients) are computed once when the query object is built.
+
+All lengths are in cm, B-field is in G
+'''
+import numpy as np
+import scipy.ndimage
+import biot_savart_v4_3 as bs
+
+class OutOfBoundsError(ValueError):
+    '''
+    Raised by FieldQuery for points outside the target volume. outside holds the indices of those points.
+    '''
+    def __init__(self, message, outside):
+        super().__init__(message)
+        self.outside = outside
+
+ORDERS = {'linear': 1, 'cubic': 3}
+
+class FieldQuery:
+    '''
+    Vectorized B-field queries at arbitrary points of a target volume.
+
+    targetVolume: (nx, ny, nz, 3) field, as returned by produce_target_volume or read_target_volume
+    box_size, start_point, vol_resolution: the grid of the volume, see produce_target_volume
+    method: 'linear' (trilinear) or 'cubic' (tricubic B-spline, smooth first and second derivatives; more accurate
+        in smooth regions, but overshoots within a grid spacing or two of the copper)
+    bounds: 'raise' to raise an OutOfBoundsError for points outside the volume,
+        'mask' to return a masked array with those points masked
+
+    Calling the object with an (N, 3) array of points (or x, y, z arrays) returns the (N, 3) field in G.
+    '''
+    def __init__(self, targetVolume, box_size, start_point, vol_resolution, method='linear', bounds='raise'):
+        if method not in ORDERS: raise ValueError(f"unknown interpolation method '{method}', expected one of {list(ORDERS)}")
+        if bounds not in ('raise', 'mask'): raise ValueError(f"bounds must be 'raise' or 'mask', not '{bounds}'")
+        self.method, self.bounds = method, bounds
+
+        axes = bs.grid_axes(box_size, start_point, vol_resolution)
+        self.shape = np.array([len(axis) for axis in axes])
+        if tuple(self.shape) + (3,) != np.shape(targetVolume):
+            raise ValueError(f"target volume of shape {np.shape(targetVolume)} does not match its grid {tuple(self.shape) + (3,)}")
+        self.origin = np.array([axis[0] for axis in axes])
+        self.spacing = np.array([(axis[-1] - axis[0]) / (len(axis) - 1) if len(axis) > 1 else 1.0 for axis in axes])
+
+        order = ORDERS[method]
+        self.coefficients = np.empty((3,) + tuple(self.shape))
+        for c in range(3):
+            component = np.asarray(targetVolume[..., c], dtype=float)
+            self.coefficients[c] = scipy.ndimage.spline_filter(component, order, mode='mirror') if order > 1 else component
+        # one contiguous array per component; for tricubic the B-spline coefficients
+
+    @classmethod
+    def from_file(cls, filename, method='linear', bounds='raise'):
+        '''
+        Builds a FieldQuery from a target volume file written by write_target_volume.
+        '''
+        return cls(bs.read_target_volume(filename, mmap_mode='r'), **bs.read_volume_grid(filename), method=method, bounds=bounds)
+
+    def indices(self, points):
+        '''
+        Returns the fractional grid indices (N, 3) of the (N, 3) points and the mask of points inside the volume.
+        '''
+        index = (np.asarray(points, dtype=float) - self.origin) / self.spacing
+        inside = ((index >= -1e-9) & (index <= self.shape - 1 + 1e-9)).all(axis=1)
+        return index, inside
+
+    def __call__(self, x, y=None, z=None):
+        '''
+        Returns the interpolated field (N, 3) at the (N, 3) points x, or at the points given by the arrays x, y, z.
+        '''
+        points = np.column_stack([np.ravel(x), np.ravel(y), np.ravel(z)]) if y is not None else np.asarray(x, dtype=float).reshape(-1, 3)
+        index, inside = self.indices(points)
+
+        if not inside.all() and self.bounds == 'raise':
+            outside = np.nonzero(~inside)[0]
+            raise OutOfBoundsError(f"{len(outside)} of {len(points)} points are outside the target volume, "
+                                   f"e.g. {tuple(points[outside[0]].tolist())}", outside)
+
+        index = np.clip(index, 0, self.shape - 1).T
+        order = ORDERS[self.method]
+        B = np.empty((len(points), 3))
+        for c in range(3):
+            B[:, c] = scipy.ndimage.map_coordinates(self.coefficients[c], index, order=order, mode='mirror', prefilter=False)
+
+        if self.bounds == 'mask': return np.ma.masked_array(B, mask=np.repeat(~inside[:, None], 3, axis=1))
+        return B
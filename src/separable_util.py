@@ -0,0 +1,178 @@
+'''
+Separable field engine for axis-aligned segments for the Biot-Savart calculator in biot_savart_v4_3.py
+
+A segment along the coordinate axis a (unit vector e_a) from s1 to s2, at the transverse offset rho of a point, has the field
+    B = I (e_a x rho) / rho^2 * ((s2 - s) / sqrt((s2 - s)^2 + rho^2) - (s1 - s) / sqrt((s1 - s)^2 + rho^2))
+s the coordinate of the point along a. On a regular grid s2 - s and s1 - s are tables along axis a, and rho^2 and
+e_a x rho are tables over the two other axes, so the 3-D offsets and cross products of every point are never formed.
+
+Square coils (vertices=4 in main.main, simple_coils/coil_square.py) consist of horizontal and vertical tracks only.
+Collinear runs of pieces (e.g. after slice_coil) are merged into one segment first; segments that are not aligned
+with an axis (diagonals, or tracks skewed by the rounding of the coil files) are summed exactly as in calculate_segment_field.
+
+All lengths are in cm, B-field is in G
+'''
+import numpy as np
+import biot_savart_v4_3 as bs
+
+AXIS_TOLERANCE = 1e-9
+# largest offset (in cm) across the axis for a segment to count as aligned with it
+ON_LINE = 1e-12
+# squared distance from the line of a segment, relative to its squared length, below which points count as on it
+SEPARABLE_FRACTION = 0.5
+# 'auto' picks the separable engine for coils with at least this fraction of aligned (merged) segments.
+# The octagons of main.main have exactly half, and the tables still make them faster than the planar engine
+
+def merge_collinear(starts, ends, currents, tol=AXIS_TOLERANCE):
+    '''
+    Merges runs of consecutive segments that continue in the same direction with the same current into single segments.
+    Returns (starts, ends, currents) like bs._straight_segments
+    '''
+    if len(starts) < 2: return starts, ends, currents
+    dl = ends - starts
+    length = np.linalg.norm(dl, axis=1)
+    cross = np.linalg.norm(np.cross(dl[:-1], dl[1:]), axis=1)
+    same = (np.abs(starts[1:] - ends[:-1]).max(axis=1) <= tol) & (currents[1:] == currents[:-1]) \
+        & (np.einsum('ij,ij->i', dl[:-1], dl[1:]) > 0) & (cross <= tol * np.maximum(length[:-1], length[1:]))
+    first = np.flatnonzero(np.concatenate(([True], ~same)))
+    last = np.concatenate((first[1:], [len(starts)])) - 1
+    return starts[first], ends[last], currents[first]
+
+def aligned_axes(starts, ends, tol=AXIS_TOLERANCE):
+    '''
+    Returns the axis (0, 1, 2) every segment is aligned with, -1 for segments that are not (or have no length).
+    '''
+    offset = np.abs(ends - starts)
+    axis = np.argmax(offset, axis=1)
+    across = offset.sum(axis=1) - offset.max(axis=1)
+    return np.where((across <= tol) & (offset.max(axis=1) > 0), axis, -1)
+
+class AlignedSegments:
+    '''
+    Straight segments of a coil with collinear runs merged, and the coordinate axis each is aligned with.
+
+    coil: Input Coil Positions (no need to slice it)
+
+    starts, ends, currents: merged segments of non-zero length, see merge_collinear
+    axis: (S,) axis every segment is aligned with, -1 for the others, see aligned_axes
+    '''
+    def __init__(self, coil):
+        starts, ends, currents = bs._straight_segments(np.asarray(coil, dtype=float))
+        keep = (ends != starts).any(axis=1)
+        # zero length segments (e.g. left by slice_coil at the vertices) carry no field but would break the runs
+        self.starts, self.ends, self.currents = merge_collinear(starts[keep], ends[keep], currents[keep])
+        self.axis = aligned_axes(self.starts, self.ends)
+
+def is_separable(coil, fraction=SEPARABLE_FRACTION):
+    '''
+    Returns True if at least fraction of the (merged) segments of the coil are aligned with an axis.
+    '''
+    segments = AlignedSegments(coil)
+    return bool(len(segments.axis)) and bool((segments.axis >= 0).mean() >= fraction)
+
+def _levi_civita(a, b):
+    # (e_a x e_b) = sign * e_c, returns (c, sign)
+    c = 3 - a - b
+    return c, (1 if (a, b, c) in ((0, 1, 2), (1, 2, 0), (2, 0, 1)) else -1)
+
+def _aligned_grid_field(starts, ends, currents, a, axes, max_bytes, dtype=np.float64):
+    '''
+    Returns the field (nx, ny, nz, 3) of segments aligned with axis a on the grid spanned by axes
+    (without the mu_0 / 4pi FACTOR).
+    dtype: Precision of the computation, the tables are formed in float64 and rounded once (see bs._sum_elements)
+    '''
+    b, c = [k for k in range(3) if k != a]
+    (kb, sign_b), (kc, sign_c) = _levi_civita(a, b), _levi_civita(a, c)
+    # e_a x rho = d_b (e_a x e_b) + d_c (e_a x e_c), i.e. sign_b d_b along kb (= c) and sign_c d_c along kc (= b)
+    n_a, n_b, n_c = len(axes[a]), len(axes[b]), len(axes[c])
+    dtype = np.dtype(dtype)
+    B = bs._Accumulator((3, n_a, n_b, n_c), dtype)
+
+    d_b = axes[b][None, :] - starts[:, b, None]
+    d_c = axes[c][None, :] - starts[:, c, None]
+    rho2 = d_b[:, :, None]**2 + d_c[:, None, :]**2
+    on_line = rho2 <= ON_LINE * ((ends[:, a] - starts[:, a])**2)[:, None, None]
+    rho2[on_line] = 1
+    scale = currents[:, None, None] / rho2
+    scale[on_line] = 0
+    along_b, along_c = sign_b * d_b[:, :, None] * scale, sign_c * d_c[:, None, :] * scale
+    # (S, n_b, n_c) tables; points on the line of a segment (within rounding) get no contribution from it,
+    # as in calculate_segment_field
+    offsets = (ends[:, a, None] - axes[a][None, :], starts[:, a, None] - axes[a][None, :])
+    # (S, n_a) tables s2 - s and s1 - s
+    rho2, along_b, along_c = (t.astype(dtype, copy=False) for t in (rho2, along_b, along_c))
+    offsets = tuple(offset.astype(dtype, copy=False) for offset in offsets)
+
+    plane = n_b * n_c
+    a_block = max(1, min(n_a, int(max_bytes) // (dtype.itemsize * 3 * plane)))
+    s_block = max(1, int(max_bytes) // (dtype.itemsize * 3 * a_block * plane))
+    buffers = np.empty((3, min(s_block, len(starts)) * a_block * plane), dtype=dtype)
+
+    for s0 in range(0, len(starts), s_block):
+        s1 = min(s0 + s_block, len(starts))
+        for a0 in range(0, n_a, a_block):
+            a1 = min(a0 + a_block, n_a)
+            size = (s1 - s0) * (a1 - a0) * plane
+            T, q, tmp = (buf[:size].reshape(s1 - s0, a1 - a0, n_b, n_c) for buf in buffers)
+            for out, offset in zip((T, tmp), offsets):
+                offset = offset[s0:s1, a0:a1, None, None]
+                np.add(offset**2, rho2[s0:s1, None], out=q)
+                np.sqrt(q, out=q)
+                np.divide(offset, q, out=out)
+            T -= tmp
+            # (s2 - s) / |R2| - (s1 - s) / |R1|
+
+            B.add((kb, slice(a0, a1)), np.einsum('sabc,sbc->abc', T, along_b[s0:s1]))
+            B.add((kc, slice(a0, a1)), np.einsum('sabc,sbc->abc', T, along_c[s0:s1]))
+
+    return np.moveaxis(B.total, (0, 1, 2, 3), (3, a, b, c))
+
+def _meshgrid_axes(x, y, z):
+    '''
+    Returns the axes (x, y, z) if x, y, z are a meshgrid(z, y, x, indexing='ij') as in produce_target_volume, else None.
+    '''
+    x, y, z = np.broadcast_arrays(np.asarray(x, dtype=float), np.asarray(y, dtype=float), np.asarray(z, dtype=float))
+    if x.ndim != 3 or x.size == 0: return None
+    axes = (x[0, 0, :], y[0, :, 0], z[:, 0, 0])
+    if not (np.array_equal(x, np.broadcast_to(axes[0][None, None, :], x.shape)) and
+            np.array_equal(y, np.broadcast_to(axes[1][None, :, None], y.shape)) and
+            np.array_equal(z, np.broadcast_to(axes[2][:, None, None], z.shape))): return None
+    return axes
+
+def calculate_separable_field(coil, x, y, z, max_bytes=bs.DEFAULT_MAX_BYTES, dtype=np.float64, stats=None):
+    '''
+    Calculates magnetic field vector as a result of some position and current x, y, z, I
+    from per-axis tables for the segments aligned with a coordinate axis, see above. Gives the result of calculate_segment_field.
+
+    Coil: Input Coil Positions in format specified above (no need to slice it), or an AlignedSegments of it
+    x, y, z: position in cm, forming a regular grid (e.g. a meshgrid of produce_target_volume);
+        scattered points are summed like calculate_segment_field
+    max_bytes: Upper bound for the scratch memory of the tables
+    dtype: np.float32 computes in single precision, see bs.calculate_field
+    stats: Optional dict, receives 'aligned' and 'other' (numbers of merged segments evaluated from tables and directly)
+
+    Output B-field is a 3-D vector in units of G, in the same layout as calculate_field
+    '''
+    points, shape = bs._as_points(x, y, z)
+    segments = coil if isinstance(coil, AlignedSegments) else AlignedSegments(coil)
+    starts, ends, currents, axis = segments.starts, segments.ends, segments.currents, segments.axis
+
+    axes, index = _meshgrid_axes(x, y, z), None
+    # a meshgrid yields the field on its axes in the order of the points, other grids are found and gathered
+    if axes is None:
+        axes, index = zip(*(np.unique(points[:, k], return_inverse=True) for k in range(3)))
+        grid = len(points) and np.prod([len(values) for values in axes]) <= 2 * len(points)
+        # points that are not (close to) a full grid would cost more as one
+        if not grid: axis = np.full(len(starts), -1)
+
+    other = axis < 0
+    B = bs._sum_segments(starts[other], ends[other], currents[other], points, max_bytes, dtype=dtype)
+    for a in range(3):
+        aligned = axis == a
+        if not aligned.any(): continue
+        field = _aligned_grid_field(starts[aligned], ends[aligned], currents[aligned], a, axes, max_bytes, dtype)
+        B += field.reshape(-1, 3) if index is None else field[index[0].ravel(), index[1].ravel(), index[2].ravel()]
+
+    if stats is not None: stats.update(aligned=int((~other).sum()), other=int(other.sum()))
+
+    return (B * bs.FACTOR).reshape(shape)
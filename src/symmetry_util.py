@@ -0,0 +1,134 @@
+'''
+Symmetry-aware target volumes for the Biot-Savart calculator in biot_savart_v4_3.py
+
+Coils with n-fold rotational symmetry about an axis parallel to z (the n-gon coils of main.main) have
+B_r, B_phi and B_z that repeat every 2 pi / n in phi, and (near) axisymmetric coils (the helical coils) have
+cylindrical components that do not depend on phi at all. The field is evaluated only on a cylindrical
+(r, phi, z) grid over the fundamental sector, or the (r, z) half-plane, and the volume is rebuilt from it.
+
+Spirals are not exactly symmetric (the track moves inwards along the turn, and there are lead-outs), so the
+rebuilt field differs from the direct one. The difference is measured at check points and reported; it is a sample, not a bound on the error of the volume.
+
+All lengths are in cm, B-field is in G
+'''
+import numpy as np
+import biot_savart_v4_3 as bs
+
+def coil_centre(coil):
+    '''
+    Returns the (x, y) centre of the bounding box of a coil.
+    '''
+    coil = np.asarray(coil, dtype=float)
+    return (coil[:2].min(axis=1) + coil[:2].max(axis=1)) / 2
+
+def sector_rings(box_size, start_point, vol_resolution, centre, symmetry):
+    '''
+    Returns the rings of the cylindrical grid about centre that covers the x-y extent of the box
+    after folding it into the fundamental sector: the ring radii r (spaced by vol_resolution)
+    and a list with the azimuths phi of every ring, spaced by about vol_resolution along the arc.
+    '''
+    corners = np.array([[start_point[0] + i * box_size[0], start_point[1] + j * box_size[1]] for i in (0, 1) for j in (0, 1)])
+    r_max = np.linalg.norm(corners - centre, axis=1).max()
+    r = np.arange(int(np.ceil(r_max / vol_resolution)) + 1) * vol_resolution
+
+    if symmetry == 'axial': return r, [np.zeros(1) for _ in r]
+    sector = 2 * np.pi / symmetry
+    return r, [np.linspace(0, sector, int(np.ceil(sector * radius / vol_resolution)) + 2) for radius in r]
+
+def _to_cylindrical(B, phi):
+    # (..., 3) Cartesian components at azimuth phi -> (B_r, B_phi, B_z)
+    c, s = np.cos(phi), np.sin(phi)
+    return np.stack([c * B[..., 0] + s * B[..., 1], c * B[..., 1] - s * B[..., 0], B[..., 2]], axis=-1)
+
+def _to_cartesian(B, phi):
+    # (..., 3) cylindrical components at azimuth phi -> (B_x, B_y, B_z)
+    c, s = np.cos(phi), np.sin(phi)
+    return np.stack([c * B[..., 0] - s * B[..., 1], s * B[..., 0] + c * B[..., 1], B[..., 2]], axis=-1)
+
+def _fold(X, Y, centre, symmetry):
+    '''
+    Returns (r, phi, folded phi) of the points X, Y about centre, the folded phi inside the fundamental sector.
+    '''
+    dx, dy = X - centre[0], Y - centre[1]
+    r, phi = np.hypot(dx, dy), np.arctan2(dy, dx)
+    if symmetry == 'axial': return r, phi, np.zeros_like(phi)
+    return r, phi, np.mod(phi, 2 * np.pi / symmetry)
+
+def produce_symmetric_volume(coil, box_size, start_point, vol_resolution, symmetry, centre=None, max_bytes=bs.DEFAULT_MAX_BYTES,
+                             engine='midpoint', check_points=64, stats=None, **engine_options):
+    '''
+    Generates a target volume from the field on the fundamental sector of a symmetric coil.
+
+    Coil: Input Coil Positions in format specified above (sub-divided with slice_coil for the 'midpoint' engine)
+    box_size, start_point, vol_resolution, max_bytes, engine_options: see produce_target_volume
+    symmetry: n for n-fold rotational symmetry about the axis through centre parallel to z,
+        or 'axial' for (near) axisymmetric coils, evaluated on the (r, z) half-plane only
+    centre: (x, y) of the symmetry axis, by default the centre of the bounding box of the coil
+    engine: Name of the field engine in ENGINES, except 'fft'
+    check_points: Number of grid points at which the result is compared to the engine (0 to skip),
+        half of them where the field is strongest
+    stats: Optional dict, receives 'evaluations' (grid points evaluated by the engine), 'points' (points of the volume),
+        'sampled_asymmetry' (max difference between the field and its symmetric image at the check points) and
+        'sampled_error' (max difference between the result and the engine at the check points), both relative to the peak field.
+        These are samples, not bounds: the error elsewhere in the volume can be larger (by 1.4x on the 91-turn octagon)
+
+    Returns an (nx, ny, nz, 3) array indexed like produce_target_volume
+    '''
+    if symmetry != 'axial' and (int(symmetry) != symmetry or symmetry < 2):
+        raise ValueError(f"symmetry must be 'axial' or an integer n >= 2, not {symmetry!r}")
+    if engine not in bs.ENGINES or engine == 'fft':
+        raise ValueError(f"the symmetric volume needs one of {[name for name in bs.ENGINES if name != 'fft']}, not '{engine}'")
+    coil = np.asarray(coil, dtype=float)
+    centre = coil_centre(coil) if centre is None else np.asarray(centre, dtype=float)
+    prepared, options = bs._PREPARE[engine](coil, **engine_options) if engine in bs._PREPARE else (coil, engine_options)
+
+    x, y, z = bs.grid_axes(box_size, start_point, vol_resolution)
+    r, phis = sector_rings(box_size, start_point, vol_resolution, centre, symmetry)
+    first = np.concatenate([[0], np.cumsum([len(phi) for phi in phis])])
+    ring_r = np.repeat(r, np.diff(first))
+    ring_phi = np.concatenate(phis)
+
+    Z, P = np.meshgrid(z, ring_phi, indexing='ij')
+    R = np.broadcast_to(ring_r, Z.shape)
+    # NOTE: Requires axes to be flipped in order for meshgrid to have the correct dimensional order
+    sector = bs.ENGINES[engine](prepared, centre[0] + R * np.cos(P), centre[1] + R * np.sin(P), Z, max_bytes, **options)
+    sector = _to_cylindrical(sector, ring_phi[:, None])
+    # (ring points, nz, 3) cylindrical components on the fundamental sector
+
+    X, Y = np.meshgrid(x, y, indexing='ij')
+    radius, azimuth, folded = _fold(X, Y, centre, symmetry)
+    i = np.minimum((radius / vol_resolution).astype(int), len(r) - 2)
+    fi = (radius - r[i]) / vol_resolution
+
+    cylindrical = 0
+    for ring, weight in ((i, 1 - fi), (i + 1, fi)):
+        count = np.diff(first)[ring]
+        step = np.where(count > 1, ring_phi[first[ring] + np.minimum(1, count - 1)], 1.0)
+        j = np.minimum((folded / step).astype(int), np.maximum(count - 2, 0))
+        fj = np.where(count > 1, folded / step - j, 0.0)
+        flat = first[ring] + j
+        cylindrical = cylindrical + (weight * (1 - fj))[..., None, None] * sector[flat]
+        cylindrical = cylindrical + (weight * fj)[..., None, None] * sector[np.minimum(flat + 1, first[ring + 1] - 1)]
+    # linear in phi along the two rings around every (x, y) column, then linear in r
+    B = _to_cartesian(cylindrical, azimuth[..., None])
+
+    if stats is not None:
+        stats.update(evaluations=R.size, points=B[..., 0].size)
+        if check_points:
+            strongest = np.argpartition(np.abs(B).max(axis=-1).ravel(), -(check_points // 2))[-(check_points // 2):]
+            spread = np.random.default_rng(0).integers(0, B[..., 0].size, check_points - check_points // 2)
+            sample = np.unravel_index(np.concatenate([strongest, spread]), B.shape[:3])
+            # half next to the copper, where interpolation and asymmetry are worst, half spread over the volume
+            px, py, pz = x[sample[0]], y[sample[1]], z[sample[2]]
+            exact = bs.ENGINES[engine](prepared, px, py, pz, max_bytes, **options)
+
+            pr, pphi, pfold = _fold(px, py, centre, symmetry)
+            image = bs.ENGINES[engine](prepared, centre[0] + pr * np.cos(pfold), centre[1] + pr * np.sin(pfold), pz, max_bytes, **options)
+            image = _to_cartesian(_to_cylindrical(image, pfold), pphi)
+            # the field at the folded point, rotated back: what a perfectly symmetric coil would give
+
+            peak = np.abs(B).max()
+            stats.update(sampled_asymmetry=float(np.abs(image - exact).max() / peak),
+                         sampled_error=float(np.abs(B[sample] - exact).max() / peak))
+
+    return B
@@ -0,0 +1,378 @@
+'''
+Barnes-Hut field engine for the Biot-Savart calculator in biot_savart_v4_3.py
+
+The midpoint elements of a sliced coil are stored in Morton (Z-order) order and grouped into an octree.
+Every cell carries a multipole expansion (up to second order) of the field of its elements.
+Groups of evaluation points use the expansion of a cell when the cell is far enough away for the
+requested tolerance, and sum the elements of a leaf directly otherwise.
+
+All lengths are in cm, B-field is in G
+'''
+import time
+import numpy as np
+import biot_savart_v4_3 as bs
+
+BITS = 16
+# bits per axis of the Morton codes, i.e. the maximum depth of the octree
+
+EPSILON = np.zeros((3, 3, 3))
+EPSILON[0, 1, 2] = EPSILON[1, 2, 0] = EPSILON[2, 0, 1] = 1
+EPSILON[0, 2, 1] = EPSILON[2, 1, 0] = EPSILON[1, 0, 2] = -1
+# Levi-Civita symbol, (a x b)_i = EPSILON_ijk a_j b_k
+
+PAIRS = [(a, b) for a in range(3) for b in range(a, 3)]
+TRIPLES = [(a, b, c) for a in range(3) for b in range(a, 3) for c in range(b, 3)]
+# distinct quadratic and cubic monomials of the offset d
+
+def _symmetrize(n_indices, monomials):
+    '''
+    Returns the (3^n_indices, len(monomials)) matrix that sums a full coefficient tensor onto distinct monomials.
+    '''
+    matrix = np.zeros((3**n_indices, len(monomials)))
+    for flat, index in enumerate(np.ndindex(*(3,) * n_indices)):
+        matrix[flat, monomials.index(tuple(sorted(index)))] = 1
+    return matrix
+
+SYMMETRIZE_2 = _symmetrize(2, PAIRS)
+SYMMETRIZE_3 = _symmetrize(3, TRIPLES)
+
+def _spread_bits(q):
+    '''
+    Spreads the lower 16 bits of q so that there are two zero bits between all of them.
+    '''
+    q = q.astype(np.uint64) & np.uint64(0xFFFF)
+    q = (q | (q << np.uint64(16))) & np.uint64(0x0000FF0000FF)
+    q = (q | (q << np.uint64(8))) & np.uint64(0x00F00F00F00F)
+    q = (q | (q << np.uint64(4))) & np.uint64(0x0C30C30C30C3)
+    q = (q | (q << np.uint64(2))) & np.uint64(0x249249249249)
+    return q
+
+def morton_order(positions):
+    '''
+    Returns (order, codes): the permutation sorting the (N, 3) positions along the Z-order curve
+    through their bounding box, and the sorted Morton codes.
+    '''
+    lo = positions.min(axis=0)
+    extent = max(float((positions.max(axis=0) - lo).max()), 1e-12)
+    q = np.minimum(((positions - lo) / extent * 2**BITS).astype(np.int64), 2**BITS - 1)
+    codes = _spread_bits(q[:, 0]) | (_spread_bits(q[:, 1]) << np.uint64(1)) | (_spread_bits(q[:, 2]) << np.uint64(2))
+    order = np.argsort(codes, kind='stable')
+    return order, codes[order]
+
+def _ranges_reduce(ufunc, values, starts, ends):
+    '''
+    Applies ufunc.reduceat to the disjoint, sorted, non-empty index ranges [starts, ends) of values.
+    '''
+    padded = np.concatenate((values, values[:1]))
+    indices = np.column_stack((starts, ends)).ravel()
+    return ufunc.reduceat(padded, indices, axis=0)[::2]
+
+class SegmentTree:
+    '''
+    Octree of the midpoint elements of a sliced coil, stored in Morton order.
+
+    coil: Input Coil Positions, already sub-divided into small pieces using slice_coil
+    leaf_size: Maximum number of elements in a leaf cell
+
+    Cells are stored level by level in flat arrays: start/end (element range), centre, radius,
+    first_child/n_children (-1/0 for leaves) and the moments of the expansion about the centre:
+        M0 = sum m, D = sum m (x) delta, E = sum (m x delta) (x) delta, F = sum m (x) delta (x) delta
+    with m = current * dl of an element and delta its offset from the cell centre.
+    The moments are folded into coefficients (n_cells, 3, 23) of the basis evaluated by _expansion_basis.
+    '''
+    def __init__(self, coil, leaf_size=32):
+        centres, dl, weights = bs._richardson_elements(np.asarray(coil, dtype=float))
+        moments = dl * weights[:, None]
+
+        self.n_elements = len(centres)
+        self.leaf_size = leaf_size
+        if self.n_elements == 0:
+            self.centres, self.moments = centres, moments
+            self.start = self.end = np.zeros(0, dtype=int)
+            return
+
+        order, codes = morton_order(centres)
+        self.centres = np.ascontiguousarray(centres[order])
+        self.moments = np.ascontiguousarray(moments[order])
+
+        starts, ends, levels, parents = [np.array([0])], [np.array([self.n_elements])], [np.array([0])], [np.array([-1])]
+        active = np.array([0])
+        # cells of the current level (as indices into the level arrays) that still need to be split
+        offset = 0
+        for level in range(1, BITS + 1):
+            s, e = starts[-1][active], ends[-1][active]
+            parent_ids = offset + active
+            split = (e - s) > leaf_size
+            if not split.any(): break
+            s, e, parent_ids = s[split], e[split], parent_ids[split]
+
+            keys = codes >> np.uint64(3 * (BITS - level))
+            # children of every split cell: runs of equal keys inside its range
+            element = np.concatenate([np.arange(a, b) for a, b in zip(s, e)])
+            owner = np.repeat(parent_ids, e - s)
+            boundary = np.ones(len(element), dtype=bool)
+            boundary[1:] = (keys[element[1:]] != keys[element[:-1]]) | (owner[1:] != owner[:-1])
+            new_starts = element[boundary]
+            new_parents = owner[boundary]
+            new_ends = np.append(new_starts[1:], 0)
+            last = np.append(new_parents[1:] != new_parents[:-1], True)
+            new_ends[last] = e[np.searchsorted(parent_ids, new_parents[last])]
+
+            offset += len(starts[-1])
+            starts.append(new_starts)
+            ends.append(new_ends)
+            levels.append(np.full(len(new_starts), level))
+            parents.append(new_parents)
+            active = np.arange(len(new_starts))
+
+        self.start = np.concatenate(starts)
+        self.end = np.concatenate(ends)
+        self.level = np.concatenate(levels)
+        parent = np.concatenate(parents)
+        # cells of one level are stored contiguously, children of a cell are stored contiguously
+
+        n_cells = len(self.start)
+        self.n_children = np.bincount(parent[1:], minlength=n_cells)
+        self.first_child = np.full(n_cells, -1)
+        has_parent = np.arange(1, n_cells)
+        first = np.ones(len(has_parent), dtype=bool)
+        first[1:] = parent[2:] != parent[1:-1]
+        self.first_child[parent[1:][first]] = has_parent[first]
+
+        self._compute_moments()
+
+    def _compute_moments(self):
+        '''
+        Computes centre, radius and the expansion moments of every cell, level by level.
+        '''
+        n_cells = len(self.start)
+        self.centre = np.empty((n_cells, 3))
+        self.radius = np.empty(n_cells)
+        M0 = np.empty((n_cells, 3))
+        D = np.empty((n_cells, 3, 3))
+        E = np.empty((n_cells, 3, 3))
+        F = np.empty((n_cells, 3, 3, 3))
+
+        for level in np.unique(self.level):
+            cells = np.flatnonzero(self.level == level)
+            s, e = self.start[cells], self.end[cells]
+            element = np.concatenate([np.arange(a, b) for a, b in zip(s, e)])
+            centres, moments = self.centres[element], self.moments[element]
+            local_s = np.concatenate(([0], np.cumsum(e - s)[:-1]))
+            local_e = local_s + (e - s)
+
+            lo = _ranges_reduce(np.minimum, centres, local_s, local_e)
+            hi = _ranges_reduce(np.maximum, centres, local_s, local_e)
+            centre = (lo + hi) / 2
+            delta = centres - np.repeat(centre, e - s, axis=0)
+
+            self.centre[cells] = centre
+            self.radius[cells] = _ranges_reduce(np.maximum, np.sqrt(np.einsum('ij,ij->i', delta, delta)), local_s, local_e)
+            M0[cells] = _ranges_reduce(np.add, moments, local_s, local_e)
+            D[cells] = _ranges_reduce(np.add, np.einsum('ka,kb->kab', moments, delta), local_s, local_e)
+            E[cells] = _ranges_reduce(np.add, np.einsum('ka,kb->kab', np.cross(moments, delta), delta), local_s, local_e)
+            F[cells] = _ranges_reduce(np.add, np.einsum('ka,kb,kc->kabc', moments, delta, delta), local_s, local_e)
+
+        self.coefficients = _expansion_coefficients(M0, D, E, F)
+
+    def leaf_elements(self, cells):
+        '''
+        Returns the element indices of the given leaf cells, padded with -1 to the largest leaf: (n_cells, n_max)
+        '''
+        counts = self.end[cells] - self.start[cells]
+        n_max = max(1, int(counts.max())) if len(cells) else 1
+        index = self.start[cells, None] + np.arange(n_max)[None, :]
+        index[np.arange(n_max)[None, :] >= counts[:, None]] = -1
+        return index
+
+def _expansion_coefficients(M0, D, E, F):
+    '''
+    Folds the moments of the cells into coefficients C (n, 3, 23) such that B = C phi(d), see _expansion_basis.
+
+    With G(d) = d / |d|^3 and m x G(d - delta) expanded to second order in delta:
+        B = M0 x d / r^3 - A / r^3 + 3 (D d) x d / r^5
+            - 3 (E d) / r^5 + 7.5 (F : d d) x d / r^7 - 1.5 (tr F) x d / r^5
+    where A = sum m x delta is the antisymmetric part of D.
+    '''
+    n = len(M0)
+    A = np.einsum('ijk,njk->ni', EPSILON, D)
+    S = np.einsum('nabb->na', F)
+
+    C = np.empty((n, 3, 23))
+    C[:, :, 0:3] = np.einsum('ijk,nj->nik', EPSILON, M0)
+    C[:, :, 3] = -A
+    C[:, :, 4:10] = 3 * np.einsum('ijk,njb->nibk', EPSILON, D).reshape(n, 3, 9) @ SYMMETRIZE_2
+    C[:, :, 10:13] = -3 * E - 1.5 * np.einsum('ijk,nj->nik', EPSILON, S)
+    C[:, :, 13:23] = 7.5 * np.einsum('ijk,njbc->nibck', EPSILON, F).reshape(n, 3, 27) @ SYMMETRIZE_3
+    return C
+
+def _expansion_basis(d):
+    '''
+    Evaluates the basis of the expansion at the offsets d (..., 3) from the cell centres:
+        d / r^3 (3), 1 / r^3, d_a d_b / r^5 (6), d / r^5 (3), d_a d_b d_c / r^7 (10)
+    '''
+    r2 = np.einsum('...i,...i->...', d, d)
+    zero = r2 == 0
+    r2[zero] = 1
+    inv2 = 1 / r2
+    inv3 = inv2 / np.sqrt(r2)
+    inv3[zero] = 0
+    inv5 = inv3 * inv2
+    inv7 = inv5 * inv2
+
+    phi = np.empty(d.shape[:-1] + (23,))
+    np.multiply(d, inv3[..., None], out=phi[..., 0:3])
+    phi[..., 3] = inv3
+    for j, (a, b) in enumerate(PAIRS):
+        np.multiply(d[..., a], d[..., b], out=phi[..., 4 + j])
+    for j, (a, b, c) in enumerate(TRIPLES):
+        np.multiply(phi[..., 4 + PAIRS.index((a, b))], d[..., c], out=phi[..., 13 + j])
+    phi[..., 4:10] *= inv5[..., None]
+    np.multiply(d, inv5[..., None], out=phi[..., 10:13])
+    phi[..., 13:23] *= inv7[..., None]
+    return phi
+
+def _expansion_field(tree, cells, d):
+    '''
+    Evaluates the multipole expansions of the given cells at the offsets d (n, P, 3) from the cell centres.
+    '''
+    return np.matmul(_expansion_basis(d), tree.coefficients[cells].transpose(0, 2, 1))
+
+def _direct_field(tree, elements, points):
+    '''
+    Sums the elements (n, L) (-1 = padding) directly at the points (n, P, 3).
+    '''
+    valid = elements >= 0
+    index = np.where(valid, elements, 0)
+    centres = tree.centres[index]
+    moments = tree.moments[index] * valid[..., None]
+
+    rx, ry, rz = (points[:, None, :, i] - centres[:, :, i, None] for i in range(3)) # (n, L, P)
+    r2 = rx * rx + ry * ry + rz * rz
+    zero = r2 == 0
+    r2[zero] = 1
+    inv3 = 1 / (r2 * np.sqrt(r2))
+    inv3[zero] = 0
+    rx *= inv3
+    ry *= inv3
+    rz *= inv3
+
+    mx, my, mz = (moments[:, None, :, i] for i in range(3)) # (n, 1, L)
+    B = np.empty(points.shape)
+    B[..., 0] = (my @ rz - mz @ ry)[:, 0]
+    B[..., 1] = (mz @ rx - mx @ rz)[:, 0]
+    B[..., 2] = (mx @ ry - my @ rx)[:, 0]
+    return B
+
+def _accumulate(result, groups, contributions):
+    '''
+    Adds contributions (n, P, 3) to result[groups] for groups sorted in ascending order.
+    '''
+    first = np.flatnonzero(np.concatenate(([True], groups[1:] != groups[:-1])))
+    result[groups[first]] += np.add.reduceat(contributions, first, axis=0)
+
+def interaction_lists(tree, group_centres, group_radii, tolerance):
+    '''
+    Walks the tree for all groups of evaluation points at once.
+
+    A cell is accepted for the expansion of a group if radius <= theta * (distance - group radius)
+    with theta = tolerance^(1/3), as the neglected third order terms are of relative size (radius / distance)^3.
+
+    Returns (far, near) as (group, cell) index arrays sorted by group; near cells are leaves summed directly.
+    '''
+    theta = tolerance ** (1/3)
+    groups = np.arange(len(group_centres))
+    cells = np.zeros(len(groups), dtype=int)
+    far, near = [], []
+
+    while len(groups):
+        distance = np.linalg.norm(group_centres[groups] - tree.centre[cells], axis=1)
+        accept = tree.radius[cells] <= theta * (distance - group_radii[groups])
+        leaf = tree.first_child[cells] < 0
+
+        far.append((groups[accept], cells[accept]))
+        near_mask = ~accept & leaf
+        near.append((groups[near_mask], cells[near_mask]))
+
+        split = ~accept & ~leaf
+        groups, cells = groups[split], cells[split]
+        counts = tree.n_children[cells]
+        groups = np.repeat(groups, counts)
+        cells = np.repeat(tree.first_child[cells] - np.cumsum(np.concatenate(([0], counts[:-1]))), counts) + np.arange(counts.sum())
+
+    far, near = (tuple(np.concatenate(part) for part in zip(*pairs)) for pairs in (far, near))
+    far, near = ((groups[np.argsort(groups, kind='stable')], cells[np.argsort(groups, kind='stable')]) for groups, cells in (far, near))
+    return far, near
+
+def calculate_tree_field(coil, x, y, z, max_bytes=bs.DEFAULT_MAX_BYTES, tolerance=1e-3, leaf_size=32, group_size=32, stats=None):
+    '''
+    Calculates magnetic field vector as a result of some position and current x, y, z, I
+    with the Barnes-Hut method. Gives the result of calculate_field up to the requested tolerance.
+
+    Coil: Input Coil Positions, already sub-divided into small pieces using slice_coil, or a SegmentTree of it
+    x, y, z: position in cm
+    max_bytes: Upper bound for the scratch memory used per batch of interactions
+    tolerance: Relative accuracy of the expansion of a far cell, compared to summing its elements directly.
+        This bounds every cell on its own; the error of the summed field is typically orders of magnitude smaller
+    leaf_size: Maximum number of coil elements in a leaf of the tree (when the tree is built here)
+    group_size: Number of evaluation points that walk the tree together
+    stats: Optional dict that receives the number of far (expansion) and near (direct) interactions
+
+    Output B-field is a 3-D vector in units of G, in the same layout as calculate_field
+    '''
+    tree = coil if isinstance(coil, SegmentTree) else SegmentTree(coil, leaf_size)
+    points, shape = bs._as_points(x, y, z)
+    n_points = len(points)
+    B = np.zeros((n_points, 3))
+    if tree.n_elements == 0 or n_points == 0: return B.reshape(shape)
+
+    order, _ = morton_order(points)
+    n_groups = -(-n_points // group_size)
+    padded = np.concatenate((order, np.full(n_groups * group_size - n_points, order[-1])))
+    grouped = points[padded].reshape(n_groups, group_size, 3)
+    # consecutive points along the Z-order curve form compact groups
+
+    lo, hi = grouped.min(axis=1), grouped.max(axis=1)
+    group_centres = (lo + hi) / 2
+    group_radii = np.linalg.norm(grouped - group_centres[:, None, :], axis=2).max(axis=1)
+
+    (far_groups, far_cells), (near_groups, near_cells) = interaction_lists(tree, group_centres, group_radii, tolerance)
+    if stats is not None:
+        stats.update(far=len(far_groups), near=len(near_groups), elements=tree.n_elements, points=n_points)
+
+    result = np.zeros((n_groups, group_size, 3))
+
+    batch = max(1, int(max_bytes) // (group_size * 8 * 40))
+    for b0 in range(0, len(far_groups), batch):
+        g, c = far_groups[b0:b0+batch], far_cells[b0:b0+batch]
+        _accumulate(result, g, _expansion_field(tree, c, grouped[g] - tree.centre[c, None, :]))
+
+    elements = tree.leaf_elements(near_cells) if len(near_cells) else np.zeros((0, 1), dtype=int)
+    batch = max(1, int(max_bytes) // (group_size * elements.shape[1] * 8 * 6))
+    for b0 in range(0, len(near_groups), batch):
+        g = near_groups[b0:b0+batch]
+        _accumulate(result, g, _direct_field(tree, elements[b0:b0+batch], grouped[g]))
+
+    B[padded[:n_points]] = result.reshape(-1, 3)[:n_points]
+    return (B * bs.FACTOR).reshape(shape)
+
+def benchmark(coil_filename, box_size, start_point, vol_resolution, coil_resolution=0.01, tolerances=(1e-2, 1e-3, 1e-5)):
+    '''
+    Compares the Barnes-Hut engine against the direct sum (calculate_field) on one target volume
+    and prints the run time and the maximum error relative to the largest field value.
+    '''
+    coil = bs.slice_coil(bs.parse_coil(coil_filename), coil_resolution)
+    print(f"{coil.shape[1]} coil pieces, resolution {vol_resolution} cm")
+
+    t0 = time.perf_counter()
+    direct = bs.produce_target_volume(coil, box_size, start_point, vol_resolution, engine='midpoint')
+    print(f"direct sum:       {time.perf_counter() - t0:8.3f} s")
+
+    scale = np.abs(direct).max()
+    for tolerance in tolerances:
+        t0 = time.perf_counter()
+        tree = bs.produce_target_volume(coil, box_size, start_point, vol_resolution, engine='tree', tolerance=tolerance)
+        print(f"tree (tol {tolerance:.0e}): {time.perf_counter() - t0:8.3f} s, max error {np.abs(tree - direct).max() / scale:.2e}")
+
+if __name__ == '__main__':
+    benchmark("../examples/9_turn_square_inductor.txt", (6, 6, 2), (1, 1, -1), 0.1)